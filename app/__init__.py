@@ -1,12 +1,19 @@
+import os
 from flask import Flask
 
 def create_app():
     app = Flask(__name__)
     app.config['UPLOAD_FOLDER'] = "app/epub_files"  # Directory to store EPUB files
     app.config['SECRET_KEY'] = 'askjhf32khr98ydshluih8'    # Required for CSRF protection in Flask forms
+    # Let a fronting Apache/lighttpd send EPUB files via X-Sendfile
+    app.config['USE_X_SENDFILE'] = os.environ.get("USE_X_SENDFILE", "0").lower() in ("1", "true", "yes")
 
     # Register Blueprints
     from .routes import main
     app.register_blueprint(main)
 
+    # Command line entry points, e.g. "flask --app app batch URL..."
+    from .cli import batch_command
+    app.cli.add_command(batch_command)
+
     return app
\ No newline at end of file
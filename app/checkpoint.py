@@ -0,0 +1,125 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .files import write_json_atomic
+
+# Where in-progress downloads record their state
+CHECKPOINT_DIRECTORY = os.environ.get(
+    "CHECKPOINT_DIRECTORY",
+    os.path.join(os.path.dirname(__file__), "data", "checkpoints")
+)
+# Checkpoints older than this many seconds are ignored and replaced
+CHECKPOINT_MAX_AGE = int(os.environ.get("CHECKPOINT_MAX_AGE", str(7 * 24 * 3600)))
+
+
+class CheckpointStore:
+    """
+    Local store of partial download state keyed by the story's starting URL.
+
+    download_story saves a checkpoint after every page so that a retried
+    download resumes from the last successful page instead of page 1. Each
+    story gets a directory holding a small state.json (metadata, pending links
+    and the partly fetched chapter) plus one file per completed chapter, so
+    saving a page never rewrites the chapters that came before it.
+
+    A checkpoint belongs to the one download holding its lock (see acquire),
+    whether that runs in this process, another server worker or the batch
+    command; concurrent downloads of the same story go without one.
+    """
+
+    def __init__(self, directory=CHECKPOINT_DIRECTORY, max_age=CHECKPOINT_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+
+    def _story_directory(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def _lock_path(self, url):
+        # Kept outside the story directory, which clear() removes while the lock is held
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "locks", f"{key}.lock")
+
+    def _chapter_path(self, url, number):
+        return os.path.join(self._story_directory(url), f"chapter_{number}.json")
+
+    def _read(self, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_json_atomic(path, data)
+
+    def acquire(self, url):
+        """
+        Take the exclusive lock on url's checkpoint and return its handle.
+
+        Returns None without waiting when another download, in any process,
+        holds it. Pass the handle to release() once the download has ended.
+        """
+        path = self._lock_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle = open(path, "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        return handle
+
+    def release(self, handle):
+        """Release a lock returned by acquire(); None is ignored."""
+        if handle is not None:
+            handle.close()
+
+    def load(self, url):
+        """
+        Return the saved state for url, or None if there is no usable checkpoint.
+
+        The completed chapters are read up front and returned as dicts in the
+        state's "chapters" list, so a resumed download never finds one missing
+        halfway through. If any of them cannot be read the checkpoint is
+        dropped and the download starts from page 1.
+        """
+        state = self._read(os.path.join(self._story_directory(url), "state.json"))
+        if state is None:
+            return None
+        if state.get("url") != url or time.time() - state.get("saved_at", 0) > self.max_age:
+            return None
+        chapters = []
+        for number in range(state.get("first_chapter", 1), state.get("chapters_completed", 0) + 1):
+            chapter = self.load_chapter(url, number)
+            if chapter is None:
+                self.clear(url)
+                return None
+            chapters.append(chapter)
+        state["chapters"] = chapters
+        return state
+
+    def save(self, url, state):
+        """Atomically replace the saved state for url."""
+        state = dict(state, url=url, saved_at=time.time())
+        self._write(os.path.join(self._story_directory(url), "state.json"), state)
+
+    def load_chapter(self, url, number):
+        """Return the saved dict for completed chapter number, or None."""
+        return self._read(self._chapter_path(url, number))
+
+    def save_chapter(self, url, number, chapter):
+        """Store completed chapter number as a dict."""
+        self._write(self._chapter_path(url, number), chapter)
+
+    def clear(self, url):
+        """Remove the checkpoint for url once its download has completed."""
+        shutil.rmtree(self._story_directory(url), ignore_errors=True)
+
+
+checkpoint_store = CheckpointStore()
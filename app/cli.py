@@ -0,0 +1,48 @@
+import time
+
+import click
+
+from .jobs import job_queue
+from .routes import validate_story_url
+from .utils import log_url, OUTPUT_PROFILES
+
+
+@click.command("batch")
+@click.argument("urls", nargs=-1)
+@click.option("--file", "url_file", type=click.File("r"),
+              help="Read URLs from this file, one per line ('-' for stdin).")
+@click.option("--poll", default=2.0, show_default=True, help="Seconds between progress reports.")
+@click.option("--profile", type=click.Choice(sorted(OUTPUT_PROFILES)),
+              help="EPUB output profile (defaults to EPUB_PROFILE).")
+def batch_command(urls, url_file, poll, profile):
+    """Download many story URLs using the shared worker pool."""
+    urls = list(urls)
+    if url_file is not None:
+        urls.extend(line.strip() for line in url_file if line.strip() and not line.startswith("#"))
+    if not urls:
+        raise click.UsageError("Give at least one URL or --file")
+
+    for url in urls:
+        log_url(url)
+    batch = job_queue.submit_batch(urls, validate=validate_story_url, profile=profile)
+    click.echo(f"Batch {batch.id}: {len(urls)} URLs queued")
+
+    reported = set()
+    while True:
+        status = batch.to_dict()
+        for item in status["items"]:
+            if item["status"] in ("pending", "queued", "running") or item["url"] in reported:
+                continue
+            reported.add(item["url"])
+            detail = item.get("saved_as") or item.get("error") or ""
+            if item.get("size"):
+                detail += f" ({item['size'] / 1024:.0f} KiB)"
+            click.echo(f"{item['status']:<9} {item['url']} {detail}")
+        if status["finished"]:
+            break
+        time.sleep(poll)
+
+    counts = ", ".join(f"{count} {name}" for name, count in sorted(status["counts"].items()))
+    click.echo(f"Batch {batch.id} finished: {counts}")
+    if any(item["status"] != "done" for item in status["items"]):
+        raise SystemExit(1)
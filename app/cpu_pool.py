@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# "thread" runs CPU-bound stages (page parsing, cover rendering, chapter
+# rendering) in the calling thread; "process" hands them to a pool of worker
+# processes so concurrent jobs are not serialized by the GIL
+CPU_MODE = os.environ.get("CPU_MODE", "thread")
+# Worker processes in the pool when CPU_MODE is "process"
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 1)))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Created lazily, and again after a fork, since a pool cannot be shared
+        # between processes. Workers are spawned rather than forked so they do
+        # not inherit locks held by this process's threads.
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(max_workers=max(1, CPU_WORKERS),
+                                            mp_context=multiprocessing.get_context("spawn"))
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _reset_executor(executor):
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+def run_cpu(function, *args):
+    """
+    Run function(*args) as a CPU-bound stage and return its result.
+
+    In process mode the call runs in the worker pool, so function must be a
+    module-level function and its arguments and result are pickled; callers
+    pass compact payloads such as page HTML or paragraph lists. If the pool
+    breaks, e.g. because a worker was killed, it is replaced and this call
+    runs inline instead.
+    """
+    if CPU_MODE != "process":
+        return function(*args)
+
+    executor = _get_executor()
+    try:
+        return executor.submit(function, *args).result()
+    except BrokenProcessPool:
+        _reset_executor(executor)
+        return function(*args)
@@ -0,0 +1,181 @@
+import os
+import re
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape, quoteattr
+
+CONTAINER_XML = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+XHTML_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{language}" xml:lang="{language}">
+<head>
+<title>{title}</title>{head}
+</head>
+<body>{body}</body>
+</html>
+"""
+
+
+def render_xhtml(title, body, language="en", stylesheet=None):
+    """Return a complete XHTML document with the given title and body markup."""
+    head = f'\n<link rel="stylesheet" type="text/css" href={quoteattr(stylesheet)}/>' if stylesheet else ""
+    return XHTML_TEMPLATE.format(language=language, title=escape(title), head=head, body=body)
+
+
+class EpubWriter:
+    """
+    Write an EPUB 3 package incrementally.
+
+    The zip container is opened as soon as the writer is created and every
+    document added with copy_document is compressed straight into it, so only
+    the small per-document manifest entries stay in memory. The package
+    document, NCX and navigation document are written by finalize once the
+    book's metadata is known.
+
+    Text members are deflated at compress_level while images, which are
+    already compressed, are stored. With minify, whitespace between tags is
+    removed from every XHTML document, and without ncx the EPUB 2 table of
+    contents, which EPUB 3 readers ignore in favour of nav.xhtml, is left out.
+    """
+
+    def __init__(self, path, language="en", identifier=None, compress_level=6, minify=False, ncx=True):
+        self.path = path
+        self.language = language
+        self.identifier = identifier or f"urn:uuid:{uuid.uuid4()}"
+        self.compress_level = compress_level
+        self.minify = minify
+        self.ncx = ncx
+        self.documents = []
+        self.front_documents = []
+        self.cover = None
+        self.stylesheet = None
+        self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, compresslevel=compress_level)
+        # The mimetype must be the first member and stored uncompressed
+        self.zip.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+        self.zip.writestr("META-INF/container.xml", CONTAINER_XML)
+
+    def _write_text(self, name, content):
+        if self.minify:
+            if isinstance(content, bytes):
+                content = content.decode("utf-8")
+            content = re.sub(r">\s+<", "><", content)
+        self.zip.writestr(name, content)
+
+    def _render(self, title, body):
+        return render_xhtml(title, body, self.language, self.stylesheet)
+
+    def copy_document(self, file_name, title, content, front=False):
+        """
+        Write one rendered XHTML document into the package and add it to the spine and TOC.
+
+        Args:
+            file_name (str): Name of the document inside the package.
+            title (str): Title used in the table of contents.
+            content (str or bytes): The complete XHTML document, e.g. one
+                rendered from a template or read from an existing EPUB.
+            front (bool): Place the document before the regular documents in
+                reading order, e.g. for a metadata page added at the end.
+        """
+        self._write_text(f"EPUB/{file_name}", content)
+        entry = {"id": os.path.splitext(file_name)[0], "href": file_name, "title": title}
+        if front:
+            self.front_documents.append(entry)
+        else:
+            self.documents.append(entry)
+
+    def add_stylesheet(self, css, file_name="style.css"):
+        """Add a CSS file shared by every document; documents rendered afterwards link to it."""
+        if self.minify:
+            css = re.sub(r"\s*([{};:,])\s*", r"\1", css).strip()
+        self.zip.writestr(f"EPUB/{file_name}", css)
+        self.stylesheet = file_name
+
+    def set_cover(self, image_data, file_name="cover.jpg"):
+        """Add a JPEG cover image and a cover page showing it."""
+        self.zip.writestr(f"EPUB/{file_name}", image_data, compress_type=zipfile.ZIP_STORED)
+        self._write_text("EPUB/cover.xhtml", self._render("Cover", f'<img src={quoteattr(file_name)} alt="Cover"/>'))
+        self.cover = file_name
+
+    def finalize(self, title, author, subjects=None):
+        """Write the package document, NCX and navigation document, then close the zip."""
+        documents = self.front_documents + self.documents
+        self._write_text("EPUB/content.opf", self._package_document(title, author, subjects or [], documents))
+        if self.ncx:
+            self._write_text("EPUB/toc.ncx", self._ncx(title, documents))
+        self._write_text("EPUB/nav.xhtml", self._nav(title, documents))
+        self.zip.close()
+
+    def abort(self):
+        """Close the zip and delete the partially written file."""
+        try:
+            self.zip.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def _package_document(self, title, author, subjects, documents):
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        metadata = [
+            f'<dc:identifier id="id">{escape(self.identifier)}</dc:identifier>',
+            f"<dc:title>{escape(title)}</dc:title>",
+            f"<dc:language>{escape(self.language)}</dc:language>",
+            f'<dc:creator id="creator">{escape(author)}</dc:creator>',
+        ]
+        metadata += [f"<dc:subject>{escape(subject)}</dc:subject>" for subject in subjects]
+        metadata.append(f'<meta property="dcterms:modified">{modified}</meta>')
+
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>']
+        if self.ncx:
+            manifest.append('<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+        spine = []
+        if self.stylesheet:
+            manifest.append(f'<item id="css" href={quoteattr(self.stylesheet)} media-type="text/css"/>')
+        if self.cover:
+            metadata.append('<meta name="cover" content="cover-img"/>')
+            manifest.append(f'<item id="cover-img" href={quoteattr(self.cover)} media-type="image/jpeg" properties="cover-image"/>')
+            manifest.append('<item id="cover" href="cover.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append('<itemref idref="cover" linear="no"/>')
+        spine.append('<itemref idref="nav"/>')
+        for document in documents:
+            manifest.append(f'<item id={quoteattr(document["id"])} href={quoteattr(document["href"])} media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref={quoteattr(document["id"])}/>')
+
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">\n'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n' + "\n".join(metadata) + "\n</metadata>\n"
+            "<manifest>\n" + "\n".join(manifest) + "\n</manifest>\n"
+            + ('<spine toc="ncx">\n' if self.ncx else "<spine>\n") + "\n".join(spine) + "\n</spine>\n"
+            "</package>\n"
+        )
+
+    def _ncx(self, title, documents):
+        nav_points = [
+            f'<navPoint id={quoteattr(document["id"])}><navLabel><text>{escape(document["title"])}</text></navLabel>'
+            f'<content src={quoteattr(document["href"])}/></navPoint>'
+            for document in documents
+        ]
+        return (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+            f'<head><meta name="dtb:uid" content={quoteattr(self.identifier)}/></head>\n'
+            f"<docTitle><text>{escape(title)}</text></docTitle>\n"
+            "<navMap>\n" + "\n".join(nav_points) + "\n</navMap>\n"
+            "</ncx>\n"
+        )
+
+    def _nav(self, title, documents):
+        items = [
+            f'<li><a href={quoteattr(document["href"])}>{escape(document["title"])}</a></li>'
+            for document in documents
+        ]
+        body = f'<nav epub:type="toc" id="toc"><h1>{escape(title)}</h1><ol>' + "".join(items) + "</ol></nav>"
+        return self._render(title, body)
@@ -0,0 +1,174 @@
+import os
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+    from lxml import etree
+except ImportError:  # pragma: no cover - lxml is listed in requirements.txt
+    lxml = None
+
+# "lxml" for the XPath fast path, "bs4" to force the BeautifulSoup html.parser path
+HTML_PARSER = os.environ.get("HTML_PARSER", "lxml")
+
+
+def _has_class(name):
+    # XPath predicate matching one class token, like BeautifulSoup's class_="name"
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# Every region download_story needs, compiled once. Each query touches only
+# the handful of elements it names instead of walking the whole document.
+_XPATH = {}
+if lxml is not None:
+    _XPATH = {
+        "title": etree.XPath(f"(//h1[{_has_class('headline')}])[1]"),
+        "author": etree.XPath(f"(//a[{_has_class('y_eU')}])[1]"),
+        "category_links": etree.XPath(
+            f"(//div[@id='BreadCrumbComponent'])[1]//a[{_has_class('h_aZ')}]"
+        ),
+        "tags": etree.XPath("//a[@class='av_as av_r']"),
+        "paragraphs": etree.XPath(f"(//div[{_has_class('aa_ht')}])[1]//p"),
+        "content": etree.XPath(f"(//div[{_has_class('aa_ht')}])[1]"),
+        "next_page": etree.XPath(f"(//a[{_has_class('l_bJ')}][@title='Next Page'])[1]/@href"),
+        "series_panel": etree.XPath("(//div[@class='panel z_r z_R'])[1]"),
+        "series_items": etree.XPath(f".//div[{_has_class('z_S')}]"),
+        "series_link": etree.XPath(f"(.//a[{_has_class('z_t')}])[1]"),
+        "series_label": etree.XPath(f"(.//span[{_has_class('z_pm')}])[1]"),
+        "series_info": etree.XPath(f".//span[{_has_class('z_pm')}][.='Series Info']"),
+        "text": etree.XPath(".//text()"),
+    }
+
+
+def _empty_page():
+    return {
+        "title": None,
+        "author": None,
+        "category": None,
+        "tags": [],
+        "has_content": False,
+        "paragraphs": [],
+        "next_page_url": None,
+        "has_series_panel": False,
+        "series_title": None,
+        "next_part_url": None,
+    }
+
+
+def _parse_with_lxml(html):
+    page = _empty_page()
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    root = lxml.html.fromstring(html, parser=lxml.html.HTMLParser(encoding="utf-8"))
+
+    title = _XPATH["title"](root)
+    if title:
+        page["title"] = title[0].text_content().strip()
+    author = _XPATH["author"](root)
+    if author:
+        page["author"] = author[0].text_content().strip()
+    category_links = _XPATH["category_links"](root)
+    if len(category_links) >= 2:
+        page["category"] = category_links[1].text_content().strip()
+    page["tags"] = [tag.text_content().strip() for tag in _XPATH["tags"](root)]
+
+    if _XPATH["content"](root):
+        page["has_content"] = True
+        # Matches BeautifulSoup's get_text(strip=True): strip each text node and join
+        page["paragraphs"] = [
+            "".join(text.strip() for text in _XPATH["text"](paragraph))
+            for paragraph in _XPATH["paragraphs"](root)
+        ]
+
+    next_page = _XPATH["next_page"](root)
+    if next_page:
+        page["next_page_url"] = str(next_page[0])
+
+    panel = _XPATH["series_panel"](root)
+    if panel:
+        page["has_series_panel"] = True
+        for item in _XPATH["series_items"](panel[0]):
+            if _XPATH["series_info"](item):
+                link = _XPATH["series_link"](item)
+                if link:
+                    page["series_title"] = link[0].text_content().strip()
+                    break
+        for item in _XPATH["series_items"](panel[0]):
+            link = _XPATH["series_link"](item)
+            if not link:
+                continue
+            label = _XPATH["series_label"](item)
+            if label and label[0].text_content().strip() == "Next Part":
+                page["next_part_url"] = link[0].get("href")
+                break
+
+    return page
+
+
+def _parse_with_bs4(html):
+    page = _empty_page()
+    soup = BeautifulSoup(html, "html.parser")
+
+    title_tag = soup.find("h1", class_="headline")
+    if title_tag:
+        page["title"] = title_tag.text.strip()
+    author_tag = soup.find("a", class_="y_eU")
+    if author_tag:
+        page["author"] = author_tag.text.strip()
+    breadcrumb = soup.find("div", id="BreadCrumbComponent")
+    if breadcrumb:
+        category_links = breadcrumb.find_all("a", class_="h_aZ")
+        if len(category_links) >= 2:
+            page["category"] = category_links[1].text.strip()
+    page["tags"] = [tag.text.strip() for tag in soup.find_all("a", class_="av_as av_r")]
+
+    content_div = soup.find("div", class_="aa_ht")
+    if content_div:
+        page["has_content"] = True
+        page["paragraphs"] = [paragraph.get_text(strip=True) for paragraph in content_div.find_all("p")]
+
+    next_page_link = soup.find("a", class_="l_bJ", title="Next Page")
+    if next_page_link:
+        page["next_page_url"] = next_page_link["href"]
+
+    series_panel = soup.find("div", class_="panel z_r z_R")
+    if series_panel:
+        page["has_series_panel"] = True
+        story_links = series_panel.find_all("div", class_="z_S")
+        for story_div in story_links:
+            if story_div.find("span", class_="z_pm", string="Series Info"):
+                link = story_div.find("a", class_="z_t")
+                if link:
+                    page["series_title"] = link.get_text().strip()
+                    break
+        for story_div in story_links:
+            link = story_div.find("a", class_="z_t")
+            if not link:
+                continue
+            next_part_span = story_div.find("span", class_="z_pm")
+            if next_part_span and next_part_span.get_text().strip() == "Next Part":
+                page["next_part_url"] = link["href"]
+                break
+
+    return page
+
+
+def parse_page(html, parser=None):
+    """
+    Extract everything download_story needs from one story page.
+
+    Uses compiled XPath queries over an lxml tree when lxml is available and
+    falls back to the BeautifulSoup html.parser path if it is not, if parser is
+    "bs4", or if lxml cannot parse the document.
+
+    Returns:
+        dict: title, author, category, tags, has_content, paragraphs,
+        next_page_url, has_series_panel, series_title and next_part_url.
+    """
+    parser = parser or HTML_PARSER
+    if parser == "lxml" and lxml is not None:
+        try:
+            return _parse_with_lxml(html)
+        except (etree.ParserError, ValueError):
+            pass
+    return _parse_with_bs4(html)
@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+from . import metrics, profiling
+from .page_cache import page_cache
+
+# Sustained requests per second allowed against a single host
+REQUEST_RATE = float(os.environ.get("REQUEST_RATE", "0.33"))
+# Number of requests that may be sent back to back before the rate applies
+REQUEST_BURST = int(os.environ.get("REQUEST_BURST", "1"))
+# Threads available for fetching pages in the background
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "4"))
+# Requests that may be in flight to a single host at once, across all jobs
+HOST_CONCURRENCY = int(os.environ.get("HOST_CONCURRENCY", "2"))
+# Retries of a request that fails with a transient error
+HTTP_RETRIES = int(os.environ.get("HTTP_RETRIES", "5"))
+# Base delay in seconds for exponential backoff between retries
+HTTP_BACKOFF = float(os.environ.get("HTTP_BACKOFF", "1.0"))
+# Longest delay in seconds before a retry; a server asking (with Retry-After)
+# for a longer wait fails the request instead of holding a thread that long
+HTTP_MAX_BACKOFF = float(os.environ.get("HTTP_MAX_BACKOFF", "60"))
+# Response statuses worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Token bucket that refills at a fixed rate up to a maximum capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and return the seconds spent waiting."""
+        if self.rate <= 0:
+            return 0.0
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimiter:
+    """Per-host collection of token buckets shared by every download in the process."""
+
+    def __init__(self, rate=REQUEST_RATE, burst=REQUEST_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """Block until a request to the host of url is allowed."""
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket.acquire()
+
+
+class HostSlots:
+    """Per-host semaphores capping concurrent requests to each host."""
+
+    def __init__(self, limit=HOST_CONCURRENCY):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """Return the semaphore guarding requests to the host of url."""
+        host = urlparse(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.get(host)
+            if semaphore is None:
+                semaphore = self.semaphores[host] = threading.BoundedSemaphore(max(1, self.limit))
+            return semaphore
+
+
+rate_limiter = RateLimiter()
+host_slots = HostSlots()
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        # Created lazily, and again after a fork, since a forked child has
+        # none of its parent's worker threads
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix="story-fetch")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def fetch_page(session, url, timeout=10, revalidate=False):
+    """
+    Return the HTML for url, preferring the page cache over the network.
+
+    Fresh cache entries are returned without any request unless revalidate is
+    set. Stale entries are revalidated with a conditional GET, and only a full
+    response is downloaded and stored. Every network request goes through the
+    per-host rate limiter and is capped at HOST_CONCURRENCY per host.
+
+    Connection errors, timeouts, 429 and 5xx responses are retried up to
+    HTTP_RETRIES times with exponential backoff, honoring Retry-After up to
+    HTTP_MAX_BACKOFF. The backoff is slept without holding a host slot, and
+    each retry waits for the rate limiter again like any other request.
+    """
+    entry = page_cache.get(url)
+    if entry is not None and not revalidate and page_cache.is_fresh(entry):
+        metrics.fetch_requests_total.inc(result="cache_hit")
+        return entry["html"]
+
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    for attempt in range(HTTP_RETRIES + 1):
+        response = None
+        with host_slots.get(url):
+            with profiling.span("rate_limit_wait"):
+                metrics.rate_limit_wait_seconds.observe(rate_limiter.wait(url))
+            start = time.perf_counter()
+            try:
+                with profiling.span("fetch"):
+                    response = session.get(url, headers=headers, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == HTTP_RETRIES:
+                    metrics.fetch_requests_total.inc(result="error")
+                    raise
+            except Exception:
+                metrics.fetch_requests_total.inc(result="error")
+                raise
+            else:
+                metrics.fetch_seconds.observe(time.perf_counter() - start, status=response.status_code)
+        if response is not None and (response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES):
+            break
+        delay = retry_delay(attempt, response)
+        if delay is None:
+            break
+        metrics.fetch_requests_total.inc(result="retry")
+        time.sleep(delay)
+
+    if response.status_code == 304 and entry is not None:
+        metrics.fetch_requests_total.inc(result="not_modified")
+        page_cache.mark_revalidated(url, entry)
+        return entry["html"]
+
+    if not response.ok:
+        metrics.fetch_requests_total.inc(result="error")
+    response.raise_for_status()
+    metrics.fetch_requests_total.inc(result="downloaded")
+    metrics.fetch_bytes_total.inc(len(response.content))
+    page_cache.put(url, response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return response.text
+
+
+def retry_delay(attempt, response=None):
+    """
+    Return the seconds to wait before retry number attempt + 1 of a failed request.
+
+    The backoff is capped at HTTP_MAX_BACKOFF. Returns None when the
+    response's Retry-After asks for longer than that, meaning give up.
+    """
+    delay = min(HTTP_MAX_BACKOFF, HTTP_BACKOFF * (2 ** attempt))
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            requested = float(retry_after)
+        except ValueError:
+            try:
+                requested = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                requested = 0
+        if requested > HTTP_MAX_BACKOFF:
+            return None
+        delay = max(delay, requested)
+    return delay
+
+
+def prefetch_page(session, url, timeout=10):
+    """Start fetching url in the background and return a Future for its HTML."""
+    return profiling.submit(_get_executor(), fetch_page, session, url, timeout)
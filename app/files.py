@@ -0,0 +1,29 @@
+import json
+import os
+import threading
+
+
+def write_atomic(path, data):
+    """
+    Replace path with the bytes in data so that readers never see a partial file.
+
+    The temporary file is named after the process and thread, so server
+    workers, the batch command and threads writing the same path at once
+    never share one.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, value, indent=None):
+    """Atomically replace path with value serialized as JSON."""
+    write_atomic(path, json.dumps(value, indent=indent).encode("utf-8"))
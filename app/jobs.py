@@ -0,0 +1,519 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .utils import (download_story, find_story_update, create_epub_file, series_entry_url, report_progress,
+                    log_action, log_error, StoredStory, StoryDownload)
+from .manifest import load_manifest
+from . import metrics
+from .profiling import Trace, JOB_TRACE, span, tracing
+
+# Number of downloads that may run at the same time
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Maximum number of jobs waiting for a worker before new submissions are rejected
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", "50"))
+# Number of finished jobs kept in memory for status lookups
+JOB_HISTORY = int(os.environ.get("JOB_HISTORY", "200"))
+# Seconds a finished download is reused for repeat submissions of the same story
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "300"))
+# Largest number of URLs accepted in one batch
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "200"))
+
+OUTPUT_DIRECTORY = os.path.join(os.path.dirname(__file__), "data", "epubs")
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another download."""
+
+
+class Job:
+    """A single story download and EPUB build tracked by the job queue."""
+
+    def __init__(self, url, update_file=None, profile=None, trace=None, next_part_url=None):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        # Name of an existing EPUB to extend with new chapters instead of a full download
+        self.update_file = update_file
+        # First new part of update_file's series when already known, so the update skips its check
+        self.next_part_url = next_part_url
+        # Output profile to build with, or None for the default
+        self.profile = profile
+        # Phase timings of the job when traced, see profiling.TRACE_MODES
+        self.trace = Trace(trace) if trace else None
+        # Submissions of the same story share one download, keyed by this
+        self.key = ("update", update_file) if update_file else ("download", url)
+        # Name of an already built EPUB to rewrite with this job's profile instead of downloading
+        self.rebuild_file = None
+        # Job for the same story with another profile that this one runs after, and
+        # the jobs waiting on this one in turn
+        self.after = None
+        self.followers = []
+        self.requests = 1
+        self.status = "queued"
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.pages_fetched = 0
+        self.chapters_done = 0
+        self.current_chapter = None
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        # Every progress and status change in order, for streaming to clients
+        self.events = []
+        self.changed = threading.Condition(self.lock)
+        self.events.append(("status", {"status": self.status}))
+
+    def _add_event(self, event, **data):
+        # Must be called with self.lock held
+        self.events.append((event, data))
+        self.changed.notify_all()
+
+    def record_progress(self, event, **data):
+        """Progress callback handed to download_story."""
+        with self.lock:
+            if event == "page":
+                self.pages_fetched += 1
+                self.current_chapter = data.get("chapter")
+            elif event == "chapter":
+                self.chapters_done += 1
+            self._add_event(event, **data)
+
+    def set_status(self, status, **data):
+        """Change the job status and record it as an event."""
+        with self.lock:
+            self.status = status
+            for name, value in data.items():
+                setattr(self, name, value)
+            self._add_event("status", status=status)
+
+    def wait_events(self, start, timeout):
+        """
+        Return the events recorded from index start onwards.
+
+        Blocks for up to timeout seconds while there are none and the job is
+        still running, so callers can stream events without polling.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while len(self.events) <= start and not self.finished:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.changed.wait(remaining)
+            return self.events[start:]
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed")
+
+    @property
+    def mode(self):
+        if self.rebuild_file or self.after:
+            return "rebuild"
+        return "update" if self.update_file else "download"
+
+    def to_dict(self):
+        """Return a JSON-serializable snapshot of the job state."""
+        with self.lock:
+            return {
+                "job_id": self.id,
+                "url": self.url,
+                "mode": self.mode,
+                "profile": self.profile,
+                "trace": self.trace.mode if self.trace else None,
+                "status": self.status,
+                "created_at": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                "started_at": self.started_at.strftime("%Y-%m-%d %H:%M:%S") if self.started_at else None,
+                "finished_at": self.finished_at.strftime("%Y-%m-%d %H:%M:%S") if self.finished_at else None,
+                "progress": {
+                    "pages_fetched": self.pages_fetched,
+                    "chapters_done": self.chapters_done,
+                    "current_chapter": self.current_chapter,
+                },
+                "requests": self.requests,
+                "error": self.error,
+            }
+
+
+class Batch:
+    """
+    A group of URLs submitted together, each tracked by its own job.
+
+    URLs wait in the batch as "pending" until the job queue has a free slot
+    for them, so a batch of any size never fills the queue.
+    """
+
+    def __init__(self, profile=None, trace=None):
+        self.id = uuid.uuid4().hex
+        self.created_at = datetime.now()
+        self.profile = profile
+        self.trace = trace
+        # One dict per submitted URL: url plus a job, a rejection reason, or
+        # neither while it is pending
+        self.items = []
+        self.next_pending = 0
+
+    def add(self, url, job=None, error=None):
+        self.items.append({"url": url, "job": job, "error": error})
+
+    def take_pending(self):
+        # Must be called with the job queue's lock held
+        while self.next_pending < len(self.items):
+            item = self.items[self.next_pending]
+            self.next_pending += 1
+            if item["job"] is None and item["error"] is None:
+                return item
+        return None
+
+    @property
+    def finished(self):
+        return all(item["error"] is not None or (item["job"] is not None and item["job"].finished)
+                   for item in self.items)
+
+    def to_dict(self):
+        """Return a JSON-serializable snapshot of every item's status."""
+        items = []
+        counts = {}
+        for item in self.items:
+            job = item["job"]
+            if item["error"] is not None:
+                entry = {"url": item["url"], "status": "rejected", "error": item["error"]}
+            elif job is None:
+                entry = {"url": item["url"], "status": "pending"}
+            else:
+                entry = job.to_dict()
+                entry["url"] = item["url"]
+                if job.result:
+                    entry["saved_as"] = job.result["saved_as"]
+                    entry["size"] = job.result.get("size")
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+            items.append(entry)
+        return {
+            "batch_id": self.id,
+            "created_at": self.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "finished": self.finished,
+            "counts": counts,
+            "items": items,
+        }
+
+
+def run_download(url, output_directory=OUTPUT_DIRECTORY, progress=None, profile=None):
+    """Download the story at url and build its EPUB, returning a result dict."""
+    os.makedirs(output_directory, exist_ok=True)
+    log_action(f"Created/verified output directory: {output_directory}")
+
+    # Chapters are downloaded while the EPUB is built, one at a time
+    log_action("Starting story download and EPUB creation...")
+    story = download_story(url, progress=progress)
+    epub_file_name = create_epub_file(story, output_directory, profile=profile)
+    log_action(f"Successfully downloaded story: '{story.title}' by {story.author}")
+    log_action(f"Successfully created EPUB file: {epub_file_name}")
+    report_progress(progress, "epub", saved_as=os.path.basename(epub_file_name), chapters=story.chapter_count)
+
+    return {
+        "message": f"Successfully downloaded '{story.title}' by {story.author}",
+        "title": story.title,
+        "author": story.author,
+        "chapters": story.chapter_count,
+        "saved_as": os.path.basename(epub_file_name),
+        "size": os.path.getsize(epub_file_name)
+    }
+
+
+def run_update(file_name, output_directory=OUTPUT_DIRECTORY, progress=None, profile=None, next_part_url=None):
+    """
+    Append any new series parts to an existing EPUB, returning a result dict.
+
+    When next_part_url, the first new part, is already known (e.g. found by
+    the series watcher) the check for new parts is skipped.
+    """
+    epub_path = os.path.join(output_directory, file_name)
+    previous = load_manifest(epub_path)
+    if previous is None:
+        raise ValueError(f"No manifest found for {file_name}; download the story again to create one")
+
+    if next_part_url:
+        story = StoryDownload(next_part_url, progress=progress, previous=previous)
+    else:
+        with span("find_story_update"):
+            story = find_story_update(previous, progress=progress)
+    if story is None:
+        return {
+            "message": f"No new chapters for '{previous['title']}' by {previous['author']}",
+            "title": previous["title"],
+            "author": previous["author"],
+            "chapters": len(previous["chapters"]),
+            "new_chapters": 0,
+            "saved_as": file_name,
+            "size": os.path.getsize(epub_path)
+        }
+
+    epub_file_name = create_epub_file(story, output_directory, previous=previous, profile=profile)
+    new_chapters = story.chapter_count - len(previous["chapters"])
+    log_action(f"Added {new_chapters} new chapters to EPUB file: {epub_file_name}")
+    report_progress(progress, "epub", saved_as=os.path.basename(epub_file_name), chapters=story.chapter_count)
+
+    return {
+        "message": f"Added {new_chapters} new chapters to '{story.title}' by {story.author}",
+        "title": story.title,
+        "author": story.author,
+        "chapters": story.chapter_count,
+        "new_chapters": new_chapters,
+        "saved_as": os.path.basename(epub_file_name),
+        "size": os.path.getsize(epub_file_name)
+    }
+
+
+def run_rebuild(file_name, output_directory=OUTPUT_DIRECTORY, progress=None, profile=None):
+    """Rewrite an existing EPUB with another output profile from its stored chapters, returning a result dict."""
+    epub_path = os.path.join(output_directory, file_name)
+    previous = load_manifest(epub_path)
+    if previous is None:
+        raise ValueError(f"No manifest found for {file_name}; download the story again to create one")
+
+    epub_file_name = create_epub_file(StoredStory(previous), output_directory, previous=previous, profile=profile)
+    log_action(f"Rebuilt EPUB file with the {profile or 'default'} profile: {epub_file_name}")
+    report_progress(progress, "epub", saved_as=os.path.basename(epub_file_name), chapters=len(previous["chapters"]))
+
+    return {
+        "message": f"Rebuilt '{previous['title']}' by {previous['author']}",
+        "title": previous["title"],
+        "author": previous["author"],
+        "chapters": len(previous["chapters"]),
+        "saved_as": os.path.basename(epub_file_name),
+        "size": os.path.getsize(epub_file_name)
+    }
+
+
+class JobQueue:
+    """
+    Bounded worker pool that runs story downloads off the request thread.
+
+    Submissions are coalesced by canonical story URL: while a job for a story
+    is queued or running, submitting it again returns the same job, and a
+    successful result is reused for result_ttl seconds afterwards as long as
+    its EPUB still exists. A submission asking for another output profile
+    never downloads the story a second time: it waits for the job in flight
+    and then rewrites that job's EPUB from the chapters stored in it.
+    """
+
+    def __init__(self, max_workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, history=JOB_HISTORY,
+                 result_ttl=RESULT_CACHE_TTL):
+        self.max_workers = max_workers
+        self.queue_limit = queue_limit
+        self.history = history
+        self.result_ttl = result_ttl
+        self.jobs = OrderedDict()
+        self.batches = OrderedDict()
+        # Batches with URLs still waiting to be submitted, oldest first
+        self.feeding = []
+        # Jobs that are queued or running, and recently completed ones, by key
+        self.inflight = {}
+        self.completed = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+
+    def _get_executor(self):
+        # Must be called with self.lock held. Created lazily, and again after
+        # a fork, since a forked child has none of its parent's worker threads
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="story-job")
+            self.executor_pid = os.getpid()
+            log_action(f"Started job worker pool with {self.max_workers} workers")
+        return self.executor
+
+    def submit(self, url, update_file=None, profile=None, trace=None, next_part_url=None):
+        """
+        Queue a download for url (or an update of update_file) and return its Job.
+
+        Returns the existing job instead when the same story with the same
+        profile is already in flight or was successfully built within the
+        result cache window. With another profile the job rebuilds the EPUB
+        of the job in flight once it finishes, or that of the recent result,
+        rather than downloading again. Any part of an already built series is
+        keyed by the URL that series was built from. A new job is traced in
+        the given mode, or in JOB_TRACE when trace is None; pass False to turn
+        tracing off. An update given next_part_url starts downloading there
+        without checking for new parts first.
+        """
+        trace = JOB_TRACE if trace is None else trace or None
+        job = Job(series_entry_url(url), update_file=update_file, profile=profile, trace=trace,
+                  next_part_url=next_part_url)
+        with self.lock:
+            existing = self._find_existing(job)
+            if existing is not None:
+                with existing.lock:
+                    existing.requests += 1
+                log_action(f"Coalesced request for {url} into job {existing.id}")
+                return existing
+
+            queued = sum(1 for j in self.jobs.values() if j.status == "queued")
+            if queued >= self.queue_limit:
+                raise QueueFullError(f"Job queue is full ({queued} downloads waiting)")
+            self.jobs[job.id] = job
+            self._prune()
+            leader = self.inflight.get(job.key)
+            if leader is not None:
+                # Started by _run once every earlier job for this story has finished
+                job.after = leader
+                leader.followers.append(job)
+                log_action(f"Queued job {job.id} for URL: {url} after job {leader.id}")
+                return job
+
+            completed = self._completed(job.key)
+            if completed is not None:
+                job.rebuild_file = completed.result["saved_as"]
+            self.inflight[job.key] = job
+            executor = self._get_executor()
+        executor.submit(self._run, job)
+        log_action(f"Queued job {job.id} for URL: {url}")
+        return job
+
+    def submit_batch(self, urls, validate=None, profile=None, trace=None):
+        """
+        Queue a download for every URL in urls and return the Batch tracking them.
+
+        URLs failing validate(url), which returns an error message or None, are
+        recorded as rejected instead of failing the whole batch. The others
+        stay pending in the batch and are submitted as workers free up, so
+        the queue keeps room for individual requests however long the batch
+        is. Every accepted URL runs on the shared worker pool, session and
+        page cache like any other job.
+        """
+        batch = Batch(profile=profile, trace=trace)
+        for url in urls:
+            batch.add(url, error=validate(url) if validate else None)
+
+        with self.lock:
+            self.batches[batch.id] = batch
+            while len(self.batches) > self.history:
+                self.batches.popitem(last=False)
+            self.feeding.append(batch)
+        log_action(f"Queued batch {batch.id} with {len(urls)} URLs")
+        self._feed_batches()
+        return batch
+
+    def _feed_batches(self):
+        # Submit pending batch URLs while fewer jobs wait than there are workers
+        while True:
+            with self.lock:
+                queued = sum(1 for j in self.jobs.values() if j.status == "queued")
+                if queued >= self.max_workers or not self.feeding:
+                    return
+                batch = self.feeding[0]
+                item = batch.take_pending()
+                if item is None:
+                    self.feeding.pop(0)
+                    continue
+            try:
+                job = self.submit(item["url"], profile=batch.profile, trace=batch.trace)
+            except QueueFullError:
+                # Individual requests filled the queue; retried when a job finishes
+                with self.lock:
+                    batch.next_pending = min(batch.next_pending, batch.items.index(item))
+                return
+            item["job"] = job
+
+    def get_batch(self, batch_id):
+        """Return the Batch with the given id, or None if it is unknown."""
+        with self.lock:
+            return self.batches.get(batch_id)
+
+    def get(self, job_id):
+        """Return the Job with the given id, or None if it is unknown."""
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def depth(self):
+        """Return the number of queued and running jobs."""
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {"queued": statuses.count("queued"), "running": statuses.count("running")}
+
+    def _find_existing(self, job):
+        # Must be called with self.lock held. Returns the queued, running or
+        # recently completed job for the same story and profile.
+        leader = self.inflight.get(job.key)
+        if leader is not None:
+            for candidate in [leader] + leader.followers:
+                if candidate.profile == job.profile:
+                    return candidate
+            return None
+
+        completed = self._completed(job.key)
+        if completed is not None and completed.profile == job.profile:
+            return completed
+        return None
+
+    def _completed(self, key):
+        # Must be called with self.lock held
+        job = self.completed.get(key)
+        if job is None:
+            return None
+        age = (datetime.now() - job.finished_at).total_seconds()
+        if age <= self.result_ttl and os.path.exists(os.path.join(OUTPUT_DIRECTORY, job.result["saved_as"])):
+            return job
+        del self.completed[key]
+        return None
+
+    def _prune(self):
+        # Drop the oldest finished jobs once the history limit is exceeded
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+
+        now = datetime.now()
+        for key, job in list(self.completed.items()):
+            if (now - job.finished_at).total_seconds() > self.result_ttl:
+                del self.completed[key]
+
+    def _run(self, job):
+        job.set_status("running", started_at=datetime.now())
+        log_action(f"Job {job.id} started")
+        try:
+            if job.after is not None:
+                if job.after.status != "done":
+                    raise ValueError(f"Job {job.after.id} for this story failed: {job.after.error}")
+                job.rebuild_file = job.after.result["saved_as"]
+            with tracing(job.trace):
+                if job.rebuild_file:
+                    result = run_rebuild(job.rebuild_file, progress=job.record_progress, profile=job.profile)
+                elif job.update_file:
+                    result = run_update(job.update_file, progress=job.record_progress, profile=job.profile,
+                                        next_part_url=job.next_part_url)
+                else:
+                    result = run_download(job.url, progress=job.record_progress, profile=job.profile)
+            job.set_status("done", result=result, finished_at=datetime.now())
+            log_action(f"Job {job.id} finished: {result['saved_as']}")
+        except Exception as e:
+            log_error(f"Job {job.id} failed: {str(e)}\n{traceback.format_exc()}", job.url)
+            job.set_status("failed", error=str(e), finished_at=datetime.now())
+        finally:
+            metrics.jobs_total.inc(status=job.status)
+            with self.lock:
+                if job.status == "done":
+                    self.completed[job.key] = job
+                if self.inflight.get(job.key) is job:
+                    del self.inflight[job.key]
+                # The next job for this story, with another profile, takes over
+                follower = job.followers.pop(0) if job.followers else None
+                if follower is not None:
+                    follower.followers = job.followers
+                    job.followers = []
+                    self.inflight[follower.key] = follower
+                    executor = self._get_executor()
+            if follower is not None:
+                executor.submit(self._run, follower)
+            self._feed_batches()
+
+job_queue = JobQueue()
+metrics.job_queue_depth.set_function(
+    lambda: [({"status": status}, count) for status, count in job_queue.depth().items()]
+)
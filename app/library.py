@@ -0,0 +1,262 @@
+import contextlib
+import fcntl
+import glob
+import itertools
+import json
+import os
+import sqlite3
+import threading
+
+from .manifest import load_manifest
+
+# SQLite database indexing every EPUB that has been built
+LIBRARY_DATABASE = os.environ.get(
+    "LIBRARY_DATABASE",
+    os.path.join(os.path.dirname(__file__), "data", "library.sqlite3")
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    source_url TEXT PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    file_name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    category TEXT,
+    tags TEXT NOT NULL,
+    series_title TEXT,
+    chapter_count INTEGER NOT NULL,
+    chapter_urls TEXT NOT NULL,
+    content_hash TEXT,
+    epub_sha256 TEXT,
+    file_size INTEGER,
+    built_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS books_author ON books (author);
+CREATE INDEX IF NOT EXISTS books_built_at ON books (built_at);
+CREATE TABLE IF NOT EXISTS watches (
+    source_url TEXT PRIMARY KEY,
+    enabled INTEGER NOT NULL DEFAULT 1,
+    next_check_at REAL NOT NULL DEFAULT 0,
+    last_checked_at REAL,
+    last_status TEXT
+);
+"""
+
+
+class Library:
+    """
+    Index of built EPUBs keyed by the story's source URL.
+
+    Each thread uses its own connection to the database, which runs in WAL
+    mode so listings never wait for a build being recorded. Choose a file
+    name and publish under it inside publishing(), so two stories with the
+    same title never claim the same file, even when built by different
+    server worker processes.
+    """
+
+    def __init__(self, database=LIBRARY_DATABASE):
+        self.database = database
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.imported = False
+
+    @contextlib.contextmanager
+    def publishing(self):
+        """
+        Hold the publish lock of this library, across threads and processes.
+
+        The thread lock orders builds within this process; an exclusive flock
+        on a file next to the database orders them between processes.
+        """
+        with self.lock:
+            os.makedirs(os.path.dirname(self.database) or ".", exist_ok=True)
+            with open(self.database + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _connect(self):
+        # Connections are per thread and are not reused after a fork
+        if getattr(self.local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.database) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.database, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def _book(self, row):
+        if row is None:
+            return None
+        book = dict(row)
+        book["tags"] = json.loads(book["tags"])
+        book["chapter_urls"] = json.loads(book["chapter_urls"])
+        return book
+
+    def get(self, source_url):
+        """Return the book built from source_url as a dict, or None."""
+        row = self._connect().execute("SELECT * FROM books WHERE source_url = ?", (source_url,)).fetchone()
+        return self._book(row)
+
+    def find_by_path(self, path):
+        """Return the book stored at path as a dict, or None."""
+        row = self._connect().execute("SELECT * FROM books WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        return self._book(row)
+
+    def find_by_chapter_url(self, url):
+        """Return the book with url as the first page of one of its chapters, or None."""
+        row = self._connect().execute(
+            "SELECT * FROM books WHERE EXISTS (SELECT 1 FROM json_each(books.chapter_urls) WHERE value = ?) "
+            "ORDER BY built_at DESC LIMIT 1",
+            (url,)
+        ).fetchone()
+        return self._book(row)
+
+    def books(self, author=None, tag=None, limit=100, offset=0):
+        """Return books newest first, optionally only those by author or tagged tag."""
+        query = "SELECT * FROM books"
+        conditions, parameters = [], []
+        if author:
+            conditions.append("author = ? COLLATE NOCASE")
+            parameters.append(author)
+        if tag:
+            conditions.append("EXISTS (SELECT 1 FROM json_each(books.tags) WHERE value = ? COLLATE NOCASE)")
+            parameters.append(tag)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY built_at DESC LIMIT ? OFFSET ?"
+        rows = self._connect().execute(query, parameters + [limit, offset]).fetchall()
+        return [self._book(row) for row in rows]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM books").fetchone()[0]
+
+    def choose_file_name(self, source_url, base_name, output_directory):
+        """
+        Return the file name the EPUB of source_url should be published under.
+
+        A story keeps the file it was built into before. Otherwise base_name
+        is used, with "-2", "-3", ... appended while that name belongs to a
+        different story.
+        """
+        output_directory = os.path.abspath(output_directory)
+        existing = self.get(source_url)
+        if existing and os.path.dirname(existing["path"]) == output_directory:
+            return existing["file_name"]
+
+        base_name = base_name or "story"
+        for number in itertools.count(1):
+            file_name = f"{base_name}.epub" if number == 1 else f"{base_name}-{number}.epub"
+            path = os.path.join(output_directory, file_name)
+            owner = self.find_by_path(path)
+            if owner is not None:
+                if owner["source_url"] == source_url:
+                    return file_name
+                continue
+            # Files built before the index existed are identified by their manifest
+            manifest = load_manifest(path) if os.path.exists(path) else None
+            if manifest and manifest.get("source_url") != source_url:
+                continue
+            return file_name
+
+    def record(self, epub_path, manifest):
+        """Add or replace the entry for the EPUB at epub_path described by manifest."""
+        path = os.path.abspath(epub_path)
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM books WHERE path = ? AND source_url != ?", (path, manifest["source_url"]))
+            connection.execute(
+                "INSERT OR REPLACE INTO books (source_url, path, file_name, title, author, category, tags, "
+                "series_title, chapter_count, chapter_urls, content_hash, epub_sha256, file_size, built_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    manifest["source_url"], path, os.path.basename(path), manifest["title"], manifest["author"],
+                    manifest["category"], json.dumps(manifest["tags"]), manifest["series_title"],
+                    len(manifest["chapters"]),
+                    json.dumps([chapter["source_urls"][0] for chapter in manifest["chapters"] if chapter["source_urls"]]),
+                    manifest.get("content_hash"), manifest.get("content_sha256"), manifest.get("file_size"),
+                    manifest["built_at"],
+                )
+            )
+
+    def remove(self, source_url):
+        connection = self._connect()
+        with connection:
+            connection.execute("DELETE FROM books WHERE source_url = ?", (source_url,))
+
+    def seed_watches(self, now, spread):
+        """
+        Start watching every built series that is not on the watch list yet.
+
+        First checks are scattered over the spread seconds after now, so a
+        large library is not checked all at once.
+        """
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO watches (source_url, next_check_at) "
+                "SELECT source_url, ? + abs(random() % ?) FROM books WHERE series_title IS NOT NULL",
+                (now, max(1, int(spread)))
+            )
+
+    def watches(self):
+        """Return every watched series joined with its book, soonest check first."""
+        rows = self._connect().execute(
+            "SELECT watches.*, books.title, books.file_name, books.path FROM watches "
+            "JOIN books ON books.source_url = watches.source_url ORDER BY next_check_at"
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def due_watches(self, now, limit):
+        """Return up to limit enabled watches whose next check is due by now."""
+        rows = self._connect().execute(
+            "SELECT watches.*, books.title, books.file_name, books.path FROM watches "
+            "JOIN books ON books.source_url = watches.source_url "
+            "WHERE enabled = 1 AND next_check_at <= ? ORDER BY next_check_at LIMIT ?",
+            (now, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def next_watch_time(self):
+        """Return when the next enabled watch is due, or None if nothing is watched."""
+        row = self._connect().execute("SELECT MIN(next_check_at) FROM watches WHERE enabled = 1").fetchone()
+        return row[0]
+
+    def update_watch(self, source_url, next_check_at, status, checked_at=None):
+        connection = self._connect()
+        with connection:
+            connection.execute(
+                "UPDATE watches SET next_check_at = ?, last_status = ?, "
+                "last_checked_at = COALESCE(?, last_checked_at) WHERE source_url = ?",
+                (next_check_at, status, checked_at, source_url)
+            )
+
+    def set_watch_enabled(self, source_url, enabled):
+        """Turn watching of a built series on or off; returns False if it is not in the library."""
+        if self.get(source_url) is None:
+            return False
+        connection = self._connect()
+        with connection:
+            connection.execute("INSERT OR IGNORE INTO watches (source_url) VALUES (?)", (source_url,))
+            connection.execute("UPDATE watches SET enabled = ? WHERE source_url = ?", (int(bool(enabled)), source_url))
+        return True
+
+    def ensure_imported(self, output_directory):
+        """Index the manifests already in output_directory the first time the library is empty."""
+        if self.imported:
+            return
+        if self.count() == 0:
+            for path in glob.glob(os.path.join(output_directory, "*.manifest.json")):
+                epub_path = path[:-len(".manifest.json")] + ".epub"
+                manifest = load_manifest(epub_path)
+                if manifest and os.path.exists(epub_path):
+                    self.record(epub_path, manifest)
+        self.imported = True
+
+
+library = Library()
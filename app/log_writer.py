@@ -0,0 +1,141 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+# Where log files are written
+LOG_DIRECTORY = os.environ.get("LOG_DIRECTORY", os.path.join(os.path.dirname(__file__), "data", "logs"))
+# "text" for the classic "timestamp - message" lines, "json" for one JSON object per line
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+# Size at which a log file is rotated to <name>.1, <name>.2, ...
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+# Number of rotated files kept per log
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+# Longest time in seconds a message waits in memory before being written
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "0.5"))
+# Messages buffered before new ones are dropped rather than blocking the caller
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "100000"))
+
+
+class LogWriter:
+    """
+    Background writer for the application's log files.
+
+    Callers only put a record on an in-memory queue. A single writer thread
+    drains the queue in batches, appends each batch to its file with one
+    open/write, and rotates files that grow past max_bytes. Because one thread
+    does all the writing, lines from concurrent downloads never interleave.
+    """
+
+    def __init__(self, directory=LOG_DIRECTORY, log_format=LOG_FORMAT, max_bytes=LOG_MAX_BYTES,
+                 backup_count=LOG_BACKUP_COUNT, flush_interval=LOG_FLUSH_INTERVAL, queue_size=LOG_QUEUE_SIZE):
+        self.directory = directory
+        self.log_format = log_format
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.dropped = 0
+
+    def _ensure_started(self):
+        # (Re)start after a fork too, since the writer thread does not survive it
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(maxsize=self.queue_size)
+                self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def write(self, file_name, message, level="info", url=None):
+        """Queue message for file_name without waiting for any I/O."""
+        self._ensure_started()
+        record = (file_name, datetime.now(), level, message, url)
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Block until every queued message has been written."""
+        if self.pid == os.getpid():
+            self.queue.join()
+
+    def _format(self, timestamp, level, message, url):
+        if self.log_format == "json":
+            record = {"time": timestamp.isoformat(timespec="milliseconds"), "level": level, "message": message}
+            if url:
+                record["url"] = url
+            return json.dumps(record) + "\n"
+
+        line = f"{timestamp.strftime('%Y-%m-%d %H:%M:%S')} - {message}"
+        if level == "error":
+            # Only add URL line if URL isn't already in the error message
+            if url and url not in message:
+                line += f"\nURL: {url}"
+            line += "\n" + "-"*50
+        return line + "\n"
+
+    def _rotate(self, path):
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+
+    def _write_batch(self, batch):
+        by_file = {}
+        for file_name, timestamp, level, message, url in batch:
+            by_file.setdefault(file_name, []).append(self._format(timestamp, level, message, url))
+        if self.dropped:
+            by_file.setdefault("log.txt", []).append(
+                self._format(datetime.now(), "info", f"Log queue full, dropped {self.dropped} messages", None)
+            )
+            self.dropped = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        for file_name, lines in by_file.items():
+            path = os.path.join(self.directory, file_name)
+            data = "".join(lines)
+            try:
+                if self.max_bytes > 0 and os.path.exists(path) and os.path.getsize(path) + len(data) > self.max_bytes:
+                    self._rotate(path)
+            except OSError:
+                pass
+            with open(path, "a") as f:
+                f.write(data)
+
+    def _run(self):
+        log_queue = self.queue
+        while True:
+            batch = [log_queue.get()]
+            # Gather whatever else arrives within the flush interval into the same write
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < 1000:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(log_queue.get(timeout=max(0, remaining)) if remaining > 0 else log_queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                pass  # Logging must never take the application down
+            finally:
+                for _ in batch:
+                    log_queue.task_done()
+
+
+log_writer = LogWriter()
+atexit.register(log_writer.flush)
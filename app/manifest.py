@@ -0,0 +1,93 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .files import write_json_atomic
+
+# Number of EPUB content hashes remembered for files without a matching manifest
+FILE_HASH_CACHE_SIZE = int(os.environ.get("FILE_HASH_CACHE_SIZE", "1024"))
+
+_file_hashes = OrderedDict()
+_file_hashes_lock = threading.Lock()
+
+
+def manifest_path(epub_path):
+    """Return the path of the manifest stored alongside epub_path."""
+    return os.path.splitext(epub_path)[0] + ".manifest.json"
+
+
+def chapter_hash(paragraphs):
+    """Return a stable content hash for a chapter's paragraphs."""
+    digest = hashlib.sha256()
+    for paragraph in paragraphs:
+        digest.update(paragraph.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def story_content_hash(title, author, category, tags, chapters):
+    """
+    Return a hash of everything that goes into a story's EPUB.
+
+    Unlike a hash of the EPUB file, which changes with every build, this only
+    changes when the metadata or a chapter's heading or text does.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps([title, author, category, tags]).encode("utf-8"))
+    for chapter in chapters:
+        digest.update(json.dumps([chapter["heading"], chapter["content_hash"]]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_manifest(epub_path):
+    """Return the manifest for epub_path as a dict, or None if it has none."""
+    try:
+        with open(manifest_path(epub_path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_manifest(epub_path, manifest):
+    """Atomically write manifest next to epub_path."""
+    write_json_atomic(manifest_path(epub_path), manifest, indent=2)
+
+
+def file_sha256(path):
+    """Return the SHA-256 hex digest of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def epub_content_hash(epub_path):
+    """
+    Return the SHA-256 of the EPUB at epub_path, preferring the one stored at build time.
+
+    The manifest's hash is only trusted while the file's size and modification
+    time still match what was recorded with it. Otherwise, e.g. for EPUBs built
+    before hashes were recorded, the file is hashed once and remembered until
+    it changes.
+    """
+    stat = os.stat(epub_path)
+    manifest = load_manifest(epub_path)
+    if (manifest and manifest.get("content_sha256") and manifest.get("file_size") == stat.st_size
+            and manifest.get("file_mtime_ns") == stat.st_mtime_ns):
+        return manifest["content_sha256"]
+
+    key = (epub_path, stat.st_size, stat.st_mtime_ns)
+    with _file_hashes_lock:
+        if key in _file_hashes:
+            _file_hashes.move_to_end(key)
+            return _file_hashes[key]
+
+    digest = file_sha256(epub_path)
+    with _file_hashes_lock:
+        _file_hashes[key] = digest
+        while len(_file_hashes) > FILE_HASH_CACHE_SIZE:
+            _file_hashes.popitem(last=False)
+    return digest
@@ -0,0 +1,185 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds for latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Upper bounds for per-story page and chapter counts
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+# Upper bounds in bytes for file size histograms
+SIZE_BUCKETS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class for a named metric whose samples are keyed by label values."""
+
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _samples(self):
+        with self.lock:
+            return [(key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for labels, value in self._samples():
+            lines.append(f"{self.name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing total."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that can go up and down, optionally computed when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, description):
+        super().__init__(name, description)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function):
+        """Compute the samples at scrape time; function returns (labels dict, value) pairs."""
+        self.function = function
+
+    def _samples(self):
+        if self.function is None:
+            return super()._samples()
+        return [(tuple(sorted(labels.items())), value) for labels, value in self.function()]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time spent inside the with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            samples = [(key, list(state["counts"]), state["sum"], state["count"]) for key, state in self.values.items()]
+        for labels, counts, total, count in samples:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (("le", _format_value(float(bound))),)
+                lines.append(f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Metrics live in process memory, so with several server processes each one
+# reports its own share of the work
+registry = Registry()
+
+fetch_seconds = registry.register(Histogram(
+    "literotica_fetch_seconds", "Time spent on HTTP requests for story pages, by response status"))
+fetch_bytes_total = registry.register(Counter(
+    "literotica_fetch_bytes_total", "Bytes of story page HTML downloaded"))
+fetch_requests_total = registry.register(Counter(
+    "literotica_fetch_requests_total", "Story page lookups by result (cache_hit, not_modified, downloaded, retry, error)"))
+rate_limit_wait_seconds = registry.register(Histogram(
+    "literotica_rate_limit_wait_seconds", "Time requests waited for the per-host rate limiter"))
+parse_seconds = registry.register(Histogram(
+    "literotica_page_parse_seconds", "Time spent extracting content from one story page"))
+pages_total = registry.register(Counter(
+    "literotica_pages_total", "Story pages downloaded and parsed"))
+chapters_total = registry.register(Counter(
+    "literotica_chapters_total", "Chapters downloaded"))
+story_pages = registry.register(Histogram(
+    "literotica_story_pages", "Pages fetched per completed story download", buckets=COUNT_BUCKETS))
+story_chapters = registry.register(Histogram(
+    "literotica_story_chapters", "Chapters fetched per completed story download", buckets=COUNT_BUCKETS))
+cover_render_seconds = registry.register(Histogram(
+    "literotica_cover_render_seconds", "Time spent rendering a cover image that was not cached"))
+cover_requests_total = registry.register(Counter(
+    "literotica_cover_requests_total", "Cover lookups by result (hit, miss)"))
+epub_build_seconds = registry.register(Histogram(
+    "literotica_epub_build_seconds", "Wall time of create_epub_file, including waiting for chapters to download"))
+epub_write_seconds = registry.register(Histogram(
+    "literotica_epub_write_seconds", "Time create_epub_file spent writing the EPUB, excluding downloads"))
+epub_bytes = registry.register(Histogram(
+    "literotica_epub_bytes", "Size of each published EPUB in bytes", buckets=SIZE_BUCKETS))
+epubs_total = registry.register(Counter(
+    "literotica_epubs_total", "EPUB builds by result (success, failure)"))
+jobs_total = registry.register(Counter(
+    "literotica_jobs_total", "Finished download jobs by status"))
+job_queue_depth = registry.register(Gauge(
+    "literotica_job_queue_depth", "Download jobs currently queued or running, by status"))
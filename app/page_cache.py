@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from .files import write_atomic, write_json_atomic
+
+# Where cached pages are stored on disk
+PAGE_CACHE_DIRECTORY = os.environ.get(
+    "PAGE_CACHE_DIRECTORY",
+    os.path.join(os.path.dirname(__file__), "data", "cache", "pages")
+)
+# Seconds a cached page is served without asking the server again
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", "3600"))
+# Upper bound on the size of the cache before least recently used pages are evicted
+PAGE_CACHE_MAX_BYTES = int(os.environ.get("PAGE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+class PageCache:
+    """
+    On-disk cache of fetched pages keyed by URL.
+
+    Each entry is stored as two files named after the SHA-256 of the URL: the raw
+    HTML and a small JSON record with the ETag, Last-Modified and fetch time used
+    for conditional revalidation. Entries are evicted least recently used first
+    once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory=PAGE_CACHE_DIRECTORY, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.total_bytes = None
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, key[:2], key)
+        return base + ".html", base + ".json"
+
+    def get(self, url):
+        """Return the cached entry for url as a dict, or None if it is not cached."""
+        if not self.enabled:
+            return None
+        html_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, "r") as f:
+                entry = json.load(f)
+            with open(html_path, "r", encoding="utf-8") as f:
+                entry["html"] = f.read()
+        except (OSError, ValueError):
+            return None
+        # The metadata file's mtime doubles as the last access time for eviction
+        try:
+            os.utime(meta_path)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        """Return True if entry may be used without revalidating it."""
+        return time.time() - entry.get("fetched_at", 0) < self.ttl
+
+    def put(self, url, html, etag=None, last_modified=None):
+        """Store html for url along with its validators."""
+        if not self.enabled:
+            return
+        html_path, meta_path = self._paths(url)
+        os.makedirs(os.path.dirname(html_path), exist_ok=True)
+        previous_size = self._entry_size(html_path, meta_path)
+
+        meta = {
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": time.time(),
+        }
+        write_atomic(html_path, html.encode("utf-8"))
+        write_json_atomic(meta_path, meta)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self._scan_size()
+            else:
+                self.total_bytes += self._entry_size(html_path, meta_path) - previous_size
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def mark_revalidated(self, url, entry):
+        """Record that the server confirmed entry is still current."""
+        if not self.enabled:
+            return
+        _, meta_path = self._paths(url)
+        meta = {key: value for key, value in entry.items() if key != "html"}
+        meta["fetched_at"] = time.time()
+        try:
+            write_json_atomic(meta_path, meta)
+        except OSError:
+            pass
+
+    def _entry_size(self, html_path, meta_path):
+        size = 0
+        for path in (html_path, meta_path):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def _entries(self):
+        # Yield (last_access, size, html_path, meta_path) for every cached page
+        if not os.path.isdir(self.directory):
+            return
+        for bucket in os.listdir(self.directory):
+            bucket_path = os.path.join(self.directory, bucket)
+            if not os.path.isdir(bucket_path):
+                continue
+            for name in os.listdir(bucket_path):
+                if not name.endswith(".json"):
+                    continue
+                meta_path = os.path.join(bucket_path, name)
+                html_path = meta_path[:-len(".json")] + ".html"
+                try:
+                    last_access = os.path.getmtime(meta_path)
+                except OSError:
+                    continue
+                yield last_access, self._entry_size(html_path, meta_path), html_path, meta_path
+
+    def _scan_size(self):
+        return sum(size for _, size, _, _ in self._entries())
+
+    def _evict(self):
+        # Remove least recently used entries until the cache is back under its limit
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, html_path, meta_path in entries:
+            if total <= self.max_bytes:
+                break
+            for path in (meta_path, html_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+        self.total_bytes = total
+
+
+page_cache = PageCache()
@@ -0,0 +1,276 @@
+import contextlib
+import contextvars
+import cProfile
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+TRACE_MODES = ("phases", "cprofile", "memory", "full")
+
+
+def parse_trace_mode(value):
+    """
+    Return the trace mode named by value.
+
+    Accepts a mode from TRACE_MODES and "1"/"true"/"yes" for "phases".
+    Returns False for "0"/"false"/"no"/"off", which turns tracing off even
+    when JOB_TRACE is set, and None for a missing or empty value, which
+    leaves the default. Raises ValueError otherwise.
+    """
+    value = (value or "").strip().lower()
+    if not value:
+        return None
+    if value in ("0", "false", "no", "off"):
+        return False
+    if value in ("1", "true", "yes", "on"):
+        return "phases"
+    if value not in TRACE_MODES:
+        raise ValueError(f"Unknown trace mode '{value}'; expected one of: {', '.join(TRACE_MODES)}")
+    return value
+
+
+# Trace every job: "phases" records wall and CPU time per phase, "cprofile"
+# adds a cProfile report of the job thread, "memory" adds peak traced heap per
+# phase and "full" captures both. Empty to only trace jobs that ask for it.
+JOB_TRACE = parse_trace_mode(os.environ.get("JOB_TRACE", "")) or None
+# Functions listed in a trace's cProfile report, by cumulative time
+TRACE_TOP_FUNCTIONS = int(os.environ.get("TRACE_TOP_FUNCTIONS", "30"))
+# Individual spans kept for a trace's timeline; phase totals always count every span
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", "2000"))
+
+# Trace and innermost open span of the running code, carried into prefetch threads
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_no_span = contextlib.nullcontext()
+
+# tracemalloc is process-wide: it runs while any memory trace is active and
+# every open span's peak is updated whenever a span starts or ends
+_memory_lock = threading.Lock()
+_memory_spans = set()
+_memory_users = 0
+_owns_tracemalloc = False
+
+
+class Trace:
+    """
+    Phase timings, and optionally a cProfile report and memory peaks, of one job.
+
+    Spans nest: wall_seconds of a phase includes its children, while
+    exclusive_seconds leaves out children that ran on the same thread. Page
+    fetches run on prefetch threads in parallel with the job, so their totals
+    can exceed the job's wall time. Memory peaks are of the whole process's
+    traced Python heap, so they are approximate while other jobs are running.
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.capture_cpu = mode in ("cprofile", "full")
+        self.capture_memory = mode in ("memory", "full")
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.spans = []
+        self.spans_dropped = 0
+        self.functions = None
+        self.notes = []
+        self.started_at = None
+        self.wall_seconds = None
+        self.start = None
+
+    def _record(self, span):
+        with self.lock:
+            key = (span.parent.name if span.parent else None, span.name)
+            phase = self.phases.get(key)
+            if phase is None:
+                phase = self.phases[key] = {
+                    "name": span.name,
+                    "parent": key[0],
+                    "count": 0,
+                    "wall_seconds": 0.0,
+                    "exclusive_seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "peak_memory_bytes": None,
+                }
+            phase["count"] += 1
+            phase["wall_seconds"] += span.wall
+            phase["exclusive_seconds"] += span.wall - span.child_wall
+            phase["cpu_seconds"] += span.cpu
+            if span.peak_bytes is not None:
+                phase["peak_memory_bytes"] = max(phase["peak_memory_bytes"] or 0, span.peak_bytes)
+
+            if len(self.spans) < TRACE_MAX_SPANS:
+                self.spans.append({
+                    "name": span.name,
+                    "parent": key[0],
+                    "thread": span.thread_name,
+                    "start_seconds": round(span.start - self.start, 6),
+                    "wall_seconds": round(span.wall, 6),
+                    "cpu_seconds": round(span.cpu, 6),
+                    "peak_memory_bytes": span.peak_bytes,
+                })
+            else:
+                self.spans_dropped += 1
+
+    def _record_profile(self, profiler):
+        stats = pstats.Stats(profiler).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TRACE_TOP_FUNCTIONS]
+        self.functions = [
+            {
+                "function": f"{function} ({os.path.basename(file_name)}:{line})",
+                "calls": calls,
+                "total_seconds": round(total, 6),
+                "cumulative_seconds": round(cumulative, 6),
+            }
+            for (file_name, line, function), (_, calls, total, cumulative, _) in rows
+        ]
+
+    @property
+    def finished(self):
+        return self.wall_seconds is not None
+
+    def to_dict(self, include_spans=False):
+        """Return a JSON-serializable summary of the trace, with every kept span if include_spans is set."""
+        with self.lock:
+            phases = [
+                dict(phase, **{name: round(phase[name], 6)
+                               for name in ("wall_seconds", "exclusive_seconds", "cpu_seconds")})
+                for phase in self.phases.values()
+            ]
+            result = {
+                "mode": self.mode,
+                "finished": self.finished,
+                "started_at": self.started_at,
+                "wall_seconds": round(self.wall_seconds, 6) if self.finished else None,
+                "phases": phases,
+                "functions": self.functions,
+                "notes": list(self.notes),
+            }
+            if include_spans:
+                result["spans"] = list(self.spans)
+                result["spans_dropped"] = self.spans_dropped
+            return result
+
+
+class _Span:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.parent = _current_span.get()
+        self.token = _current_span.set(self)
+        self.thread_name = threading.current_thread().name
+        self.child_wall = 0.0
+        self.peak_bytes = None
+        self.memory = self.trace.capture_memory and tracemalloc.is_tracing()
+        if self.memory:
+            with _memory_lock:
+                _memory_checkpoint()
+                self.memory_start = self.peak = tracemalloc.get_traced_memory()[0]
+                _memory_spans.add(self)
+        self.start = time.perf_counter()
+        self.cpu_start = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter() - self.start
+        self.cpu = time.thread_time() - self.cpu_start
+        if self.memory:
+            with _memory_lock:
+                _memory_checkpoint()
+                _memory_spans.discard(self)
+            self.peak_bytes = max(0, self.peak - self.memory_start)
+        _current_span.reset(self.token)
+        # Children on other threads overlap their parent rather than being part of it
+        if self.parent is not None and self.parent.thread_name == self.thread_name:
+            self.parent.child_wall += self.wall
+        self.trace._record(self)
+        return False
+
+
+def _memory_checkpoint():
+    # Must be called with _memory_lock held. Folds the heap peak since the
+    # previous checkpoint into every open span, then starts a new interval.
+    peak = tracemalloc.get_traced_memory()[1]
+    for span in _memory_spans:
+        span.peak = max(span.peak, peak)
+    tracemalloc.reset_peak()
+
+
+def _start_memory():
+    global _memory_users, _owns_tracemalloc
+    with _memory_lock:
+        if _memory_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _owns_tracemalloc = True
+        _memory_users += 1
+
+
+def _stop_memory():
+    global _memory_users, _owns_tracemalloc
+    with _memory_lock:
+        _memory_users -= 1
+        if _memory_users == 0 and _owns_tracemalloc:
+            tracemalloc.stop()
+            _owns_tracemalloc = False
+
+
+def span(name):
+    """
+    Return a context manager timing the enclosed code as phase name of the current trace.
+
+    Costs a single context variable lookup when nothing is being traced.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _no_span
+    return _Span(trace, name)
+
+
+def submit(executor, function, *args):
+    """Submit function(*args) to executor so that it records spans into the caller's trace."""
+    if _current_trace.get() is None:
+        return executor.submit(function, *args)
+    return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+@contextlib.contextmanager
+def tracing(trace):
+    """
+    Record the enclosed code into trace as a "job" span.
+
+    Starts tracemalloc and a cProfile profiler of the calling thread when
+    the trace's mode asks for them. Does nothing when trace is None.
+    """
+    if trace is None:
+        yield None
+        return
+
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    trace.started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    trace.start = time.perf_counter()
+    if trace.capture_memory:
+        _start_memory()
+    profiler = None
+    if trace.capture_cpu:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Only one profiler can run per thread
+            trace.notes.append(f"cProfile unavailable: {str(e)}")
+            profiler = None
+    try:
+        with span("job"):
+            yield trace
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            trace._record_profile(profiler)
+        if trace.capture_memory:
+            _stop_memory()
+        trace.wall_seconds = time.perf_counter() - trace.start
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
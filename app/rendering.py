@@ -0,0 +1,29 @@
+import os
+
+from jinja2 import Environment, FileSystemLoader
+
+from .manifest import chapter_hash
+
+# Name of the stylesheet shared by every document in the EPUB
+STYLESHEET_NAME = "style.css"
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(__file__), "templates", "epub")
+
+# Templates are compiled once per process, when this module is imported
+_environment = Environment(loader=FileSystemLoader(TEMPLATE_DIRECTORY), autoescape=True)
+CHAPTER_TEMPLATE = _environment.get_template("chapter.xhtml")
+METADATA_TEMPLATE = _environment.get_template("metadata.xhtml")
+with open(os.path.join(TEMPLATE_DIRECTORY, STYLESHEET_NAME), "r", encoding="utf-8") as _stylesheet:
+    STYLESHEET = _stylesheet.read()
+
+
+def render_chapter(heading, paragraphs, language="en"):
+    """Return a chapter's complete XHTML document and the content hash of its paragraphs."""
+    document = CHAPTER_TEMPLATE.render(heading=heading, paragraphs=paragraphs, language=language,
+                                       stylesheet=STYLESHEET_NAME)
+    return document, chapter_hash(paragraphs)
+
+
+def render_metadata(category=None, tags=None, language="en"):
+    """Return the XHTML document of the "Story Information" page."""
+    return METADATA_TEMPLATE.render(category=category, tags=tags, language=language, stylesheet=STYLESHEET_NAME)
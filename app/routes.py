@@ -1,18 +1,37 @@
-from flask import Blueprint, request, render_template, send_from_directory, jsonify, abort
-from .utils import download_story, create_epub_file, log_error, log_action
+from flask import Blueprint, Response, request, render_template, send_file, jsonify, abort, url_for, stream_with_context
+from .utils import log_error, log_action, log_url, OUTPUT_PROFILES
+from .jobs import job_queue, QueueFullError, BATCH_MAX_URLS
+from .manifest import load_manifest, epub_content_hash
+from .metrics import registry
+from .library import library
+from .profiling import parse_trace_mode
+from .watcher import series_watcher, WATCHER_ENABLED
+import json
 import os
-from datetime import datetime
-import traceback
 import urllib.parse
 
 # Blueprint for module routing
 main = Blueprint('main', __name__)
 
+# Seconds between keep-alive comments on an idle event stream
+SSE_KEEPALIVE = int(os.environ.get("SSE_KEEPALIVE", "15"))
+# Internal location (e.g. "/protected-epubs/") a fronting nginx serves the EPUB
+# directory from; when set, file transfers are handed off with X-Accel-Redirect
+DOWNLOAD_ACCEL_REDIRECT = os.environ.get("DOWNLOAD_ACCEL_REDIRECT", "")
+# Seconds a download requested with its version (?v=<content hash>) may be cached
+DOWNLOAD_MAX_AGE = int(os.environ.get("DOWNLOAD_MAX_AGE", str(365 * 24 * 3600)))
+
+@main.before_app_request
+def start_series_watcher():
+    # Started on the first request so command line runs never start it
+    if WATCHER_ENABLED:
+        series_watcher.ensure_started()
+
 @main.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         url = request.form.get("url")
-        return process_url(url)
+        return process_url(url, request.form.get("profile") or None, request.form.get("trace"))
 
     log_action("Serving index page")
     return render_template("index.html")
@@ -33,13 +52,7 @@ def api_download():
     log_action(f"API request received for URL: {url}")
     
     # Log all URLs first, regardless of validity
-    log_directory = os.path.join(os.path.dirname(__file__), "data", "logs")
-    os.makedirs(log_directory, exist_ok=True)
-    url_log = os.path.join(log_directory, "url_log.txt")
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(url_log, "a") as f:
-        f.write(f"{timestamp} - {url}\n")
-    log_action("URL logged to url_log.txt")
+    log_url(url)
     
     # Check if URL is from allowed domain
     if not url.startswith("https://www.literotica.com/"):
@@ -50,18 +63,52 @@ def api_download():
             "message": error_msg
         }), 400
 
-    return process_url(url)
+    return process_url(url, request.args.get("profile") or None, request.args.get("trace"))
+
+def invalid_profile_response(profile):
+    """Return a 400 response if profile names no output profile, otherwise None."""
+    if profile is None or profile in OUTPUT_PROFILES:
+        return None
+    log_error(f"Unknown output profile requested: {profile}")
+    return jsonify({
+        "success": "false",
+        "message": f"Unknown profile '{profile}'; expected one of: {', '.join(OUTPUT_PROFILES)}"
+    }), 400
 
-def process_url(url):
-    """Process the URL and create EPUB file."""
+def requested_trace_mode(value):
+    """
+    Return (trace mode, None) for a trace request parameter, or (None, 400 response) if it is invalid.
+
+    The mode is None when the parameter is missing, so JOB_TRACE applies, and
+    False when it asks for tracing to be off.
+    """
+    try:
+        return parse_trace_mode(value), None
+    except ValueError as e:
+        log_error(str(e))
+        return None, (jsonify({
+            "success": "false",
+            "message": str(e)
+        }), 400)
+
+def queued_job_response(job, message):
+    """Return the 202 response pointing a client at a queued job's endpoints."""
+    response = {
+        "success": "true",
+        "message": message,
+        "job_id": job.id,
+        "status_url": url_for("main.job_status", job_id=job.id),
+        "result_url": url_for("main.job_result", job_id=job.id),
+        "events_url": url_for("main.job_events", job_id=job.id)
+    }
+    if job.trace:
+        response["trace_url"] = url_for("main.job_trace", job_id=job.id)
+    return jsonify(response), 202
+
+def process_url(url, profile=None, trace=None):
+    """Validate the URL and queue a background job that creates the EPUB file."""
     # Log all URLs first, regardless of validity
-    log_directory = os.path.join(os.path.dirname(__file__), "data", "logs")
-    os.makedirs(log_directory, exist_ok=True)
-    url_log = os.path.join(log_directory, "url_log.txt")
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with open(url_log, "a") as f:
-        f.write(f"{timestamp} - {url}\n")
-    log_action("URL logged to url_log.txt")
+    log_url(url)
 
     # Check if URL is from allowed domain
     if not url.startswith("https://www.literotica.com/"):
@@ -72,63 +119,331 @@ def process_url(url):
             "message": "Invalid URL domain"
         }), 400
 
+    error_response = invalid_profile_response(profile)
+    if error_response:
+        return error_response
+    trace, error_response = requested_trace_mode(trace)
+    if error_response:
+        return error_response
+
+    try:
+        job = job_queue.submit(url, profile=profile, trace=trace)
+    except QueueFullError as e:
+        log_error(str(e), url)
+        return jsonify({
+            "success": "false",
+            "message": str(e)
+        }), 503
+
+    return queued_job_response(job, "Download queued")
+
+def validate_story_url(url):
+    """Return an error message if url cannot be downloaded, otherwise None."""
+    if not url.startswith("https://www.literotica.com/"):
+        return f"Invalid URL domain: {url}"
+    return None
+
+@main.route("/api/batch", methods=["POST"])
+def api_batch():
+    """Queue downloads for many story URLs in one call."""
+    data = request.get_json(silent=True)
+    if data is not None:
+        urls = data.get("urls") if isinstance(data, dict) else data
+        profile = data.get("profile") if isinstance(data, dict) else None
+        trace = data.get("trace") if isinstance(data, dict) else None
+    else:
+        # Form posts may send one URL per line
+        urls = request.form.get("urls", "").splitlines()
+        profile = request.form.get("profile")
+        trace = request.form.get("trace")
+    profile = profile or request.args.get("profile") or None
+    error_response = invalid_profile_response(profile)
+    if error_response:
+        return error_response
+    if trace is None:
+        trace = request.args.get("trace")
+    trace, error_response = requested_trace_mode(None if trace is None else str(trace))
+    if error_response:
+        return error_response
+
+    if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+        return jsonify({
+            "success": "false",
+            "message": "Expected a JSON list of URLs in 'urls'"
+        }), 400
+
+    urls = [url.strip() for url in urls if url.strip()]
+    if not urls:
+        return jsonify({
+            "success": "false",
+            "message": "At least one URL is required"
+        }), 400
+    if len(urls) > BATCH_MAX_URLS:
+        return jsonify({
+            "success": "false",
+            "message": f"A batch may contain at most {BATCH_MAX_URLS} URLs"
+        }), 400
+
+    log_action(f"Batch request received for {len(urls)} URLs")
+    for url in urls:
+        log_url(url)
+
+    batch = job_queue.submit_batch(urls, validate=validate_story_url, profile=profile, trace=trace)
+    return jsonify(dict(
+        batch.to_dict(),
+        success="true",
+        status_url=url_for("main.batch_status", batch_id=batch.id)
+    )), 202
+
+@main.route("/api/batch/<batch_id>")
+def batch_status(batch_id):
+    """Report the status of every URL in a batch."""
+    batch = job_queue.get_batch(batch_id)
+    if batch is None:
+        return jsonify({
+            "success": "false",
+            "message": f"Unknown batch: {batch_id}"
+        }), 404
+
+    return jsonify(dict(batch.to_dict(), success="true"))
+
+@main.route("/api/update")
+def api_update():
+    """API endpoint to add newly published parts to an already downloaded series."""
+    filename = request.args.get('file')
+    if not filename or '..' in filename or filename.startswith('/'):
+        log_error(f"API update request with invalid file parameter: {filename}")
+        return jsonify({
+            "success": "false",
+            "message": "A valid file parameter is required"
+        }), 400
+
+    profile = request.args.get("profile") or None
+    error_response = invalid_profile_response(profile)
+    if error_response:
+        return error_response
+    trace, error_response = requested_trace_mode(request.args.get("trace"))
+    if error_response:
+        return error_response
+
     output_directory = os.path.join(os.path.dirname(__file__), "data", "epubs")
-    os.makedirs(output_directory, exist_ok=True)
-    log_action(f"Created/verified output directory: {output_directory}")
+    previous = load_manifest(os.path.join(output_directory, filename))
+    if previous is None:
+        return jsonify({
+            "success": "false",
+            "message": f"No manifest found for {filename}"
+        }), 404
 
+    log_action(f"API update request received for file: {filename}")
     try:
-        # Download the story and generate the EPUB
-        log_action("Starting story download...")
-        story_content, story_title, story_author, story_category, story_tags = download_story(url)
-        if not story_content:
-            error_msg = f"Failed to download the story from the given URL: {url}"
-            log_error(error_msg, url)
-            log_action(f"Download failed: {error_msg}")
+        job = job_queue.submit(previous["source_url"], update_file=filename, profile=profile, trace=trace)
+    except QueueFullError as e:
+        log_error(str(e), previous["source_url"])
+        return jsonify({
+            "success": "false",
+            "message": str(e)
+        }), 503
+
+    return queued_job_response(job, "Update queued")
+
+@main.route("/api/library")
+def api_library():
+    """List the EPUBs that have been built, newest first, optionally filtered by author or tag."""
+    output_directory = os.path.join(os.path.dirname(__file__), "data", "epubs")
+    library.ensure_imported(output_directory)
+    limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+    offset = max(0, request.args.get("offset", 0, type=int))
+    books = library.books(author=request.args.get("author"), tag=request.args.get("tag"), limit=limit, offset=offset)
+    for book in books:
+        # Where the file lives on the server is not the client's business
+        del book["path"]
+        book["download_url"] = url_for("main.download_file", filename=book["file_name"], v=book["epub_sha256"])
+    return jsonify({
+        "success": "true",
+        "count": len(books),
+        "books": books
+    })
+
+@main.route("/api/watch", methods=["GET", "POST"])
+def api_watch():
+    """List followed series, or turn following one on or off with file and enabled parameters."""
+    if request.method == "POST":
+        data = request.get_json(silent=True) or request.form
+        filename = data.get("file")
+        enabled = str(data.get("enabled", "1")).lower() in ("1", "true", "yes")
+        output_directory = os.path.join(os.path.dirname(__file__), "data", "epubs")
+        book = library.find_by_path(os.path.join(output_directory, filename)) if filename else None
+        if book is None or not library.set_watch_enabled(book["source_url"], enabled):
             return jsonify({
                 "success": "false",
-                "message": error_msg
-            })
-
-        log_action(f"Successfully downloaded story: '{story_title}' by {story_author}")
-        log_action("Starting EPUB creation...")
-
-        epub_file_name = create_epub_file(
-            story_title, 
-            story_author, 
-            story_content, 
-            output_directory,
-            story_category=story_category,
-            story_tags=story_tags
-        )
-        log_action(f"Successfully created EPUB file: {epub_file_name}")
-
-        # Get the base filename without path
-        base_filename = os.path.basename(epub_file_name)
-
-        return jsonify({
-            "success": "true",
-            "message": f"Successfully downloaded '{story_title}' by {story_author}",
-            "title": story_title,
-            "author": story_author,
-            "saved_as": base_filename
-        })
-    except Exception as e:
-        error_msg = f"{str(e)}\n{traceback.format_exc()}"
-        log_error(error_msg, url)
-        log_action(f"Error occurred: {str(e)}")
+                "message": f"No library entry for {filename}"
+            }), 404
+        log_action(f"{'Watching' if enabled else 'Stopped watching'} series: {filename}")
+
+    watches = library.watches()
+    for watch in watches:
+        del watch["path"]
+    return jsonify({
+        "success": "true",
+        "count": len(watches),
+        "watches": watches
+    })
+
+@main.route("/api/jobs/<job_id>")
+def job_status(job_id):
+    """Report the status and progress of a queued download."""
+    job = job_queue.get(job_id)
+    if job is None:
         return jsonify({
             "success": "false",
-            "message": str(e)
-        })
+            "message": f"Unknown job: {job_id}"
+        }), 404
+
+    return jsonify(dict(job.to_dict(), success="true"))
+
+@main.route("/api/jobs/<job_id>/result")
+def job_result(job_id):
+    """Return the result of a finished download."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": "false",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+
+    if not job.finished:
+        return jsonify({
+            "success": "false",
+            "status": job.status,
+            "message": "Download is still in progress"
+        }), 202
+
+    return jsonify(job_outcome(job))
+
+@main.route("/api/jobs/<job_id>/trace")
+def job_trace(job_id):
+    """
+    Report where a traced job spent its time.
+
+    Lists wall, exclusive and CPU seconds and peak memory per phase, and the
+    top functions by cumulative time when the job was traced with cProfile.
+    Pass spans=1 to also get every individual span. A running job reports
+    the phases finished so far.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": "false",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+    if job.trace is None:
+        return jsonify({
+            "success": "false",
+            "message": "Job was not traced; submit it with trace=phases, cprofile, memory or full"
+        }), 404
+
+    include_spans = request.args.get("spans", "").lower() in ("1", "true", "yes")
+    return jsonify(dict(job.trace.to_dict(include_spans), success="true", job_id=job.id, status=job.status))
+
+def job_outcome(job):
+    """Return the result payload of a finished job."""
+    if job.status == "failed":
+        return {
+            "success": "false",
+            "status": job.status,
+            "message": job.error
+        }
+    output_directory = os.path.join(os.path.dirname(__file__), "data", "epubs")
+    try:
+        version = epub_content_hash(os.path.join(output_directory, job.result["saved_as"]))
+    except OSError:
+        version = None
+    return dict(job.result, success="true", status=job.status,
+                download_url=url_for("main.download_file", filename=job.result["saved_as"], v=version))
+
+@main.route("/api/jobs/<job_id>/events")
+def job_events(job_id):
+    """
+    Stream a job's progress as Server-Sent Events.
+
+    Replays every event recorded so far (status changes, "page", "chapter"
+    and "epub"), then pushes new ones as the download runs. The stream ends
+    with a "result" event carrying the same payload as the result endpoint.
+    Clients reconnecting with Last-Event-ID only receive the events they missed.
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": "false",
+            "message": f"Unknown job: {job_id}"
+        }), 404
+
+    start = request.headers.get("Last-Event-ID", "")
+    start = int(start) + 1 if start.isdigit() else 0
+
+    def stream(position):
+        while True:
+            events = job.wait_events(position, timeout=SSE_KEEPALIVE)
+            for event, data in events:
+                yield f"id: {position}\nevent: {event}\ndata: {json.dumps(data)}\n\n"
+                position += 1
+            if job.finished and len(job.events) <= position:
+                yield f"event: result\ndata: {json.dumps(job_outcome(job))}\n\n"
+                return
+            if not events:
+                # Comment line that keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+
+    # The final result event builds URLs, so the request context must outlive this view
+    return Response(stream_with_context(stream(start)), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+@main.route("/metrics")
+def metrics():
+    """Expose download pipeline metrics in the Prometheus text format."""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
 
 @main.route("/download/<filename>")
 def download_file(filename):
-    """Download a specific EPUB file."""
+    """
+    Download a specific EPUB file.
+
+    Responses carry a strong ETag of the file's content hash and support
+    conditional and Range requests. Requests that name the current version
+    (?v=<content hash>) may be cached indefinitely, anything else must be
+    revalidated. The transfer itself is handed to the fronting proxy when
+    DOWNLOAD_ACCEL_REDIRECT or USE_X_SENDFILE is configured.
+    """
     # Basic security check: ensure filename doesn't contain path traversal
     if '..' in filename or filename.startswith('/'):
         log_action(f"Attempted path traversal in download: {filename}")
         abort(404)
-        
+
     output_directory = os.path.join(os.path.dirname(__file__), "data", "epubs")
+    path = os.path.join(output_directory, filename)
+    if not os.path.isfile(path):
+        abort(404)
     log_action(f"Download requested for file: {filename}")
-    return send_from_directory(output_directory, filename, as_attachment=True)
\ No newline at end of file
+
+    etag = epub_content_hash(path)
+    if DOWNLOAD_ACCEL_REDIRECT:
+        response = Response(mimetype="application/epub+zip")
+        response.headers["X-Accel-Redirect"] = DOWNLOAD_ACCEL_REDIRECT.rstrip("/") + "/" + urllib.parse.quote(filename)
+        response.headers.set("Content-Disposition", "attachment", filename=filename)
+        response.set_etag(etag)
+        # nginx answers Range requests itself; only revalidation is handled here
+        response = response.make_conditional(request)
+    else:
+        response = send_file(path, mimetype="application/epub+zip", as_attachment=True,
+                             download_name=filename, conditional=True, etag=etag)
+
+    if request.args.get("v") == etag:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = DOWNLOAD_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,139 @@
+import fcntl
+import os
+import random
+import threading
+import time
+
+from .fetch import TokenBucket
+from .jobs import job_queue, QueueFullError, OUTPUT_DIRECTORY
+from .library import library
+from .manifest import load_manifest
+from .utils import find_story_update, log_action, log_error
+
+# Set to 0 to stop checking followed series for new parts
+WATCHER_ENABLED = os.environ.get("WATCHER_ENABLED", "1").lower() in ("1", "true", "yes")
+# Seconds between checks of the same series
+WATCH_INTERVAL = int(os.environ.get("WATCH_INTERVAL", str(6 * 3600)))
+# Fraction of WATCH_INTERVAL each check is moved earlier or later by at random,
+# so series downloaded together are not all checked at once
+WATCH_JITTER = float(os.environ.get("WATCH_JITTER", "0.2"))
+# Seconds before checking again after a check failed or the job queue was full
+WATCH_RETRY_DELAY = int(os.environ.get("WATCH_RETRY_DELAY", "1800"))
+# Most series checks made per hour across all followed series
+WATCH_CHECKS_PER_HOUR = float(os.environ.get("WATCH_CHECKS_PER_HOUR", "60"))
+# File locked by the one process (of possibly several server workers) running the watcher
+WATCHER_LOCK_FILE = os.environ.get(
+    "WATCHER_LOCK_FILE",
+    os.path.join(os.path.dirname(__file__), "data", "watcher.lock")
+)
+
+
+class SeriesWatcher:
+    """
+    Background checker for new parts of followed series.
+
+    Every series in the library is followed unless disabled. For each one
+    only the last page of its last known chapter is requested, as a
+    conditional GET so an unchanged page costs a 304, and its series panel
+    is inspected for a "Next Part" link. An update job is queued only when a
+    new part exists. Checks are spread out with jitter and all of them draw
+    from one budget of checks_per_hour, on top of the per-host rate limit
+    every request is subject to.
+    """
+
+    def __init__(self, interval=WATCH_INTERVAL, jitter=WATCH_JITTER, retry_delay=WATCH_RETRY_DELAY,
+                 checks_per_hour=WATCH_CHECKS_PER_HOUR, lock_file=WATCHER_LOCK_FILE):
+        self.interval = interval
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.budget = TokenBucket(checks_per_hour / 3600, 1)
+        self.lock_file = lock_file
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.stop_event = threading.Event()
+
+    def ensure_started(self):
+        """Start the watcher thread in this process if it is not running yet."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.stop_event = threading.Event()
+                self.thread = threading.Thread(target=self._run, name="series-watcher", daemon=True)
+                self.thread.start()
+                self.pid = os.getpid()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _next_time(self, delay):
+        return time.time() + delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _acquire_file_lock(self):
+        # Only one process runs the checks; the lock is released when it exits
+        os.makedirs(os.path.dirname(self.lock_file), exist_ok=True)
+        handle = open(self.lock_file, "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return None
+        return handle
+
+    def _run(self):
+        lock_handle = None
+        while not self.stop_event.is_set():
+            if lock_handle is None:
+                lock_handle = self._acquire_file_lock()
+                if lock_handle is None:
+                    # Another worker is watching; take over if it goes away
+                    self.stop_event.wait(60)
+                    continue
+                log_action(f"Series watcher started in process {os.getpid()}")
+
+            try:
+                library.ensure_imported(OUTPUT_DIRECTORY)
+                library.seed_watches(time.time(), self.interval)
+                for watch in library.due_watches(time.time(), limit=10):
+                    if self.stop_event.is_set():
+                        break
+                    self.budget.acquire()
+                    self.check(watch)
+                next_time = library.next_watch_time()
+            except Exception as e:
+                log_error(f"Series watcher failed: {str(e)}")
+                next_time = None
+
+            delay = 60 if next_time is None else next_time - time.time()
+            self.stop_event.wait(min(60, max(1, delay)))
+
+    def check(self, watch):
+        """Check one watched series and queue an update job if it has a new part."""
+        source_url = watch["source_url"]
+        previous = load_manifest(watch["path"]) if os.path.exists(watch["path"]) else None
+        if previous is None or not previous["chapters"]:
+            library.update_watch(source_url, self._next_time(self.interval), "missing", time.time())
+            return
+
+        try:
+            update = find_story_update(previous)
+        except Exception as e:
+            library.update_watch(source_url, self._next_time(self.retry_delay), f"error: {str(e)}", time.time())
+            return
+
+        if update is None:
+            library.update_watch(source_url, self._next_time(self.interval), "no new parts", time.time())
+            return
+
+        try:
+            # The update starts at the part just found rather than checking again
+            job = job_queue.submit(source_url, update_file=watch["file_name"], next_part_url=update.url)
+        except QueueFullError:
+            library.update_watch(source_url, self._next_time(self.retry_delay), "queue full", time.time())
+            return
+        log_action(f"Series watcher found a new part of '{watch['title']}', queued job {job.id}")
+        library.update_watch(source_url, self._next_time(self.interval), f"update queued: {job.id}", time.time())
+
+
+series_watcher = SeriesWatcher()
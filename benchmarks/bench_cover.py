@@ -0,0 +1,119 @@
+"""
+Measure cover rendering throughput before and after the cover cache.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_cover [--covers N]
+
+Compares the original render path (fonts loaded and text measured on every
+call, LANCZOS downsampling), an uncached render with the current code and
+repeat requests served from the cover cache. Logs go to a temporary
+directory that is removed afterwards.
+"""
+import argparse
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+WORK_DIRECTORY = tempfile.mkdtemp(prefix="epub-bench-")
+# The application reads this when its modules are imported
+os.environ.setdefault("LOG_DIRECTORY", os.path.join(WORK_DIRECTORY, "logs"))
+
+from app import utils  # noqa: E402
+from app.log_writer import log_writer  # noqa: E402
+
+TITLES = [
+    ("A Long Night", "nightwriter"),
+    ("The Lighthouse Keeper's Daughter and the Storm That Changed Everything", "harborlights"),
+    ("Summer", "anon"),
+    ("Letters From the River Town: A Slow Burn in Seven Parts", "inkwell_42"),
+]
+
+
+def legacy_render_cover(title, author):
+    """The cover render path as it was before caching, kept for comparison."""
+    width, height = 1200, 1600
+    background_color = utils.COVER_BACKGROUND_COLORS[
+        int(hashlib.md5(title.encode()).hexdigest(), 16) % len(utils.COVER_BACKGROUND_COLORS)
+    ]
+    spine_color = tuple(max(0, c - 20) for c in background_color)
+    image = Image.new("RGB", (width, height), background_color)
+    draw = ImageDraw.Draw(image, 'RGBA')
+    draw.rectangle([(0, 0), (40, height)], fill=spine_color)
+
+    font_path = os.path.join(os.path.dirname(utils.__file__), "static", "fonts", "Open_Sans", "OpenSans-VariableFont_wdth,wght.ttf")
+    title_font = ImageFont.truetype(font_path, 128)
+    author_font = ImageFont.truetype(font_path, 72)
+    max_text_width = width - 140
+
+    lines = []
+    current_line = []
+    for word in title.split():
+        test_line = ' '.join(current_line + [word])
+        bbox = draw.textbbox((0, 0), test_line, font=title_font)
+        if bbox[2] - bbox[0] <= max_text_width:
+            current_line.append(word)
+        elif current_line:
+            lines.append(' '.join(current_line))
+            current_line = [word]
+        else:
+            lines.append(word)
+            current_line = []
+    if current_line:
+        lines.append(' '.join(current_line))
+
+    total_text_height = sum(draw.textbbox((0, 0), line, font=title_font)[3] - draw.textbbox((0, 0), line, font=title_font)[1] for line in lines)
+    total_text_height += 40 * (len(lines) - 1)
+    current_y = (height // 3) - (total_text_height // 2)
+    for line in lines:
+        bbox = draw.textbbox((0, 0), line, font=title_font)
+        draw.text(((width - (bbox[2] - bbox[0])) // 2, current_y), line, fill=(255, 255, 255), font=title_font)
+        current_y += bbox[3] - bbox[1] + 40
+
+    author_bbox = draw.textbbox((0, 0), author, font=author_font)
+    draw.text(((width - (author_bbox[2] - author_bbox[0])) // 2, height - 200), author, fill=(255, 255, 255), font=author_font)
+
+    image = image.resize((600, 800), Image.Resampling.LANCZOS)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=95, optimize=True)
+    return buffer.getvalue()
+
+
+def covers_per_second(render, count):
+    start = time.perf_counter()
+    for i in range(count):
+        title, author = TITLES[i % len(TITLES)]
+        render(title, author)
+    return count / (time.perf_counter() - start)
+
+
+def uncached_render(title, author):
+    utils._cover_cache.clear()
+    return utils.render_cover(title, author)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--covers", type=int, default=40, help="covers rendered per variant")
+    args = arg_parser.parse_args()
+
+    try:
+        utils.get_cover_fonts()  # the new path loads fonts once per process
+        print(f"{'variant':<12}{'covers/sec':>12}")
+        print(f"{'legacy':<12}{covers_per_second(legacy_render_cover, args.covers):>12.1f}")
+        print(f"{'uncached':<12}{covers_per_second(uncached_render, args.covers):>12.1f}")
+        for title, author in TITLES:
+            utils.render_cover(title, author)
+        print(f"{'cached':<12}{covers_per_second(utils.render_cover, args.covers):>12.1f}")
+        log_writer.flush()
+    finally:
+        shutil.rmtree(WORK_DIRECTORY, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Compare the lxml/XPath and BeautifulSoup extraction paths on saved story pages.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_parse [--repeat N] [FIXTURE.html ...]
+
+Reports mean per-page parse time and peak traced memory for each parser and
+checks that both produce the same extracted data. Peak memory comes from
+tracemalloc, so it covers Python allocations only; libxml2's own buffers are
+not included in the lxml figure.
+"""
+import argparse
+import glob
+import os
+import time
+import tracemalloc
+
+from app.extract import parse_page
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(__file__), "fixtures")
+PARSERS = ("lxml", "bs4")
+
+
+def time_parse(html, parser, repeat):
+    """Return the mean seconds taken to parse html with parser."""
+    parse_page(html, parser=parser)  # warm up compiled queries and imports
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse_page(html, parser=parser)
+    return (time.perf_counter() - start) / repeat
+
+
+def peak_memory(html, parser):
+    """Return the peak traced memory in bytes while parsing html once."""
+    tracemalloc.start()
+    try:
+        parse_page(html, parser=parser)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("fixtures", nargs="*", help="HTML pages to parse (defaults to benchmarks/fixtures/*.html)")
+    arg_parser.add_argument("--repeat", type=int, default=50, help="parses per page and parser")
+    args = arg_parser.parse_args()
+
+    paths = args.fixtures or sorted(glob.glob(os.path.join(FIXTURE_DIRECTORY, "*.html")))
+    print(f"{'page':<28}{'parser':<8}{'ms/page':>10}{'peak KiB':>12}")
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            html = f.read()
+
+        results = {parser: parse_page(html, parser=parser) for parser in PARSERS}
+        if results["lxml"] != results["bs4"]:
+            print(f"WARNING: parsers disagree on {path}")
+
+        for parser in PARSERS:
+            seconds = time_parse(html, parser, args.repeat)
+            peak = peak_memory(html, parser)
+            print(f"{os.path.basename(path):<28}{parser:<8}{seconds * 1000:>10.2f}{peak / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
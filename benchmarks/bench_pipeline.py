@@ -0,0 +1,145 @@
+"""
+Measure the download and EPUB pipeline end to end against a local fixture server.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline [--parts N] [--pages N] [--latency-ms MS] [--runs N]
+
+Starts benchmarks.fixture_server in-process, so no request leaves the machine,
+and reports for download_story and create_epub_file:
+
+    pages/sec      pages fetched and parsed per second by download_story
+    story latency  wall time from first request to published EPUB
+    build time     create_epub_file on already downloaded chapters
+    peak memory    largest Python heap (tracemalloc) during each stage
+
+The rate limiter is off and the page cache disabled unless REQUEST_RATE or
+PAGE_CACHE_MAX_BYTES are set in the environment. Logs, checkpoints, cached
+pages, the library index and EPUBs go to a temporary directory that is
+removed afterwards.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fixture_server import FixtureConfig, FixtureServer
+
+WORK_DIRECTORY = tempfile.mkdtemp(prefix="epub-bench-")
+# The application reads these when its modules are imported
+os.environ.setdefault("REQUEST_RATE", "0")
+os.environ.setdefault("PAGE_CACHE_MAX_BYTES", "0")
+os.environ.setdefault("LOG_DIRECTORY", os.path.join(WORK_DIRECTORY, "logs"))
+os.environ.setdefault("CHECKPOINT_DIRECTORY", os.path.join(WORK_DIRECTORY, "checkpoints"))
+os.environ.setdefault("PAGE_CACHE_DIRECTORY", os.path.join(WORK_DIRECTORY, "pages"))
+os.environ.setdefault("LIBRARY_DATABASE", os.path.join(WORK_DIRECTORY, "library.sqlite3"))
+
+from app import utils  # noqa: E402
+from app.log_writer import log_writer  # noqa: E402
+
+OUTPUT_DIRECTORY = os.path.join(WORK_DIRECTORY, "epubs")
+
+
+class RecordedStory:
+    """Already downloaded chapters replayed to create_epub_file without any network access."""
+
+    def __init__(self, story, chapters):
+        self.url = story.url
+        self.title = story.title
+        self.author = story.author
+        self.category = story.category
+        self.tags = story.tags
+        self.series_title = story.series_title
+        self.chapters = chapters
+
+    def __iter__(self):
+        return iter(self.chapters)
+
+
+def download(url):
+    """Download every chapter and return (story, chapters, pages fetched)."""
+    pages = []
+    story = utils.download_story(url, progress=lambda event, **data: pages.append(1) if event == "page" else None)
+    chapters = list(story)
+    return story, chapters, len(pages)
+
+
+def end_to_end(url, profile=None):
+    # Forget the previous build so unchanged content is written again rather than skipped
+    utils.library.remove(url)
+    utils._cover_cache.clear()
+    return utils.create_epub_file(utils.download_story(url), OUTPUT_DIRECTORY, profile=profile)
+
+
+def build(recorded, profile=None):
+    utils.library.remove(recorded.url)
+    utils._cover_cache.clear()
+    return utils.create_epub_file(recorded, OUTPUT_DIRECTORY, profile=profile)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def peak_memory(function, *args):
+    """Return the peak traced Python heap in bytes while function runs."""
+    tracemalloc.start()
+    try:
+        function(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--parts", type=int, default=5, help="parts (chapters) in the series")
+    arg_parser.add_argument("--pages", type=int, default=4, help="pages per part")
+    arg_parser.add_argument("--paragraphs", type=int, default=25, help="paragraphs per page")
+    arg_parser.add_argument("--latency-ms", type=float, default=20, help="delay added to every response")
+    arg_parser.add_argument("--runs", type=int, default=3, help="timed runs per measurement")
+    arg_parser.add_argument("--profile", choices=sorted(utils.OUTPUT_PROFILES), default=utils.EPUB_PROFILE,
+                            help="EPUB output profile")
+    args = arg_parser.parse_args()
+
+    config = FixtureConfig(args.parts, args.pages, args.paragraphs, args.latency_ms / 1000)
+    server = FixtureServer(config).start()
+    url = server.first_url
+    utils.get_cover_fonts()
+
+    try:
+        download_times, story_times, build_times = [], [], []
+        pages = 0
+        for _ in range(args.runs):
+            elapsed, (story, chapters, pages) = timed(download, url)
+            download_times.append(elapsed)
+            story_times.append(timed(end_to_end, url, args.profile)[0])
+            build_times.append(timed(build, RecordedStory(story, chapters), args.profile)[0])
+
+        recorded = RecordedStory(story, chapters)
+        download_peak = peak_memory(download, url)
+        build_peak = peak_memory(build, recorded, args.profile)
+        epub_size = os.path.getsize(end_to_end(url, args.profile))
+        log_writer.flush()
+
+        print(f"fixture: {args.parts} parts x {args.pages} pages, {args.paragraphs} paragraphs/page, "
+              f"{args.latency_ms:g} ms latency, REQUEST_RATE={os.environ['REQUEST_RATE']}")
+        print(f"pages per story:   {pages}  (server saw {server.requests} requests in total)")
+        print(f"pages/sec:         {pages / statistics.median(download_times):10.1f}")
+        print(f"story latency:     {statistics.median(story_times) * 1000:10.1f} ms")
+        print(f"EPUB build time:   {statistics.median(build_times) * 1000:10.1f} ms")
+        print(f"peak memory:       {download_peak / 1024:10.0f} KiB download_story, "
+              f"{build_peak / 1024:.0f} KiB create_epub_file")
+        print(f"EPUB size:         {epub_size / 1024:10.1f} KiB  ({args.profile} profile)")
+    finally:
+        server.shutdown()
+        shutil.rmtree(WORK_DIRECTORY, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
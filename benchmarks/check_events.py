@@ -0,0 +1,90 @@
+"""
+Check that a job's progress stream ends with its result event.
+
+Run from the repository root:
+
+    python -m benchmarks.check_events
+
+Serves the application with a real werkzeug server, queues a download of a
+benchmarks.fixture_server story and reads /api/jobs/<id>/events until the
+stream closes. Exits non-zero unless the last event is a successful
+"result" carrying a download_url. The EPUB it builds is removed afterwards.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import requests
+from werkzeug.serving import make_server
+
+from benchmarks.fixture_server import FixtureConfig, FixtureServer
+
+WORK_DIRECTORY = tempfile.mkdtemp(prefix="epub-check-")
+# The application reads these when its modules are imported
+os.environ.setdefault("REQUEST_RATE", "0")
+os.environ.setdefault("WATCHER_ENABLED", "0")
+os.environ.setdefault("LOG_DIRECTORY", os.path.join(WORK_DIRECTORY, "logs"))
+os.environ.setdefault("CHECKPOINT_DIRECTORY", os.path.join(WORK_DIRECTORY, "checkpoints"))
+os.environ.setdefault("PAGE_CACHE_DIRECTORY", os.path.join(WORK_DIRECTORY, "pages"))
+os.environ.setdefault("LIBRARY_DATABASE", os.path.join(WORK_DIRECTORY, "library.sqlite3"))
+
+from app import create_app  # noqa: E402
+from app.jobs import job_queue, OUTPUT_DIRECTORY  # noqa: E402
+from app.log_writer import log_writer  # noqa: E402
+
+
+def read_events(response):
+    """Yield (event, data) for every event in a text/event-stream response."""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line == "":
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data.append(line[len("data: "):])
+
+
+def main():
+    fixture = FixtureServer(FixtureConfig(parts=2, pages=2, paragraphs=5, latency=0.01)).start()
+    server = make_server("127.0.0.1", 0, create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    saved_as = None
+
+    try:
+        job = job_queue.submit(fixture.first_url)
+        with requests.get(f"{base_url}/api/jobs/{job.id}/events", stream=True, timeout=60) as response:
+            events = list(read_events(response))
+
+        names = [event for event, _ in events]
+        print(f"received {len(events)} events: {', '.join(names)}")
+        if not events or names[-1] != "result":
+            print("FAIL: stream did not end with a result event")
+            return 1
+        result = events[-1][1]
+        saved_as = result.get("saved_as")
+        if result.get("success") != "true" or not result.get("download_url"):
+            print(f"FAIL: unexpected result event: {result}")
+            return 1
+        print(f"OK: result event for {saved_as} with {result['download_url']}")
+        return 0
+    finally:
+        server.shutdown()
+        fixture.shutdown()
+        log_writer.flush()
+        if saved_as:
+            epub_path = os.path.join(OUTPUT_DIRECTORY, saved_as)
+            for path in (epub_path, epub_path[:-len(".epub")] + ".manifest.json"):
+                if os.path.exists(path):
+                    os.remove(path)
+        shutil.rmtree(WORK_DIRECTORY, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""
+Local stand-in for Literotica serving synthetic multi-page, multi-part series.
+
+Pages use the same markup hooks the scraper relies on: the h1.headline title,
+a.y_eU author, BreadCrumbComponent category links, av_as tag links, the
+aa_ht content div, the l_bJ "Next Page" link and the z_r series panel with
+z_S/z_pm "Series Info" and "Next Part" entries.
+
+URLs look like /s/<series>-part-<n>?page=<p>. Responses carry an ETag and
+honor If-None-Match so conditional revalidation can be measured too.
+
+Run standalone with:
+
+    python -m benchmarks.fixture_server --port 8765 --parts 5 --pages 4
+"""
+import argparse
+import hashlib
+import random
+import re
+import threading
+import time
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WORDS = (
+    "the night was quiet and she walked along the river under lamps thinking about "
+    "what he had said before leaving town in the morning light with letters"
+).split()
+
+
+class FixtureConfig:
+    """Shape of the synthetic series and how slowly it is served."""
+
+    def __init__(self, parts=3, pages=3, paragraphs=25, latency=0.0, series="bench-series"):
+        self.parts = parts
+        self.pages = pages
+        self.paragraphs = paragraphs
+        self.latency = latency
+        self.series = series
+
+
+def _paragraph(rng):
+    sentences = []
+    for _ in range(rng.randint(3, 7)):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 20))]
+        sentences.append(" ".join(words).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def render_page(config, base_url, part, page):
+    """Return the HTML for one page of one part of the synthetic series."""
+    rng = random.Random(f"{config.series}-{part}-{page}")
+    part_url = f"{base_url}/s/{config.series}-part-{part}"
+    html = [
+        '<!DOCTYPE html><html lang="en"><head><meta charset="utf-8">',
+        f"<title>Bench Series Ch. {part:02d} - Literotica.com</title></head><body>",
+        '<header class="b_a"><nav>',
+        "".join(f'<a class="c_L" href="/c/category-{i}">Category {i}</a>' for i in range(60)),
+        "</nav></header>",
+        '<div id="BreadCrumbComponent"><a class="h_aZ" href="/">Home</a> / ',
+        '<a class="h_aZ" href="/c/romance-stories">Romance</a></div>',
+        f'<h1 class="j_bm headline">Bench Series Ch. {part:02d}</h1>',
+        '<a class="y_eU" href="/authors/benchwriter">benchwriter</a>',
+        '<div class="panel article"><div class="aa_ht"><div>',
+        "".join(f"<p>{escape(_paragraph(rng))}</p>" for _ in range(config.paragraphs)),
+        "</div></div></div>",
+    ]
+    if page < config.pages:
+        html.append(f'<a class="l_bJ" href="{part_url}?page={page + 1}" title="Next Page">Next</a>')
+    html.append("".join(f'<a class="av_as av_r" href="/tags/{tag}">{tag}</a>' for tag in ("slow burn", "river", "letters")))
+    if page == config.pages:
+        html.append('<div class="panel z_r z_R">')
+        html.append(f'<div class="z_S"><a class="z_t" href="{base_url}/series/se/{config.series}">Bench Series</a><span class="z_pm">Series Info</span></div>')
+        if part < config.parts:
+            html.append(f'<div class="z_S"><a class="z_t" href="{base_url}/s/{config.series}-part-{part + 1}">Bench Series Ch. {part + 1:02d}</a><span class="z_pm">Next Part</span></div>')
+        html.append("</div>")
+    html.append('<section class="comments">')
+    html.append("".join(f'<div class="cm_a"><p class="cm_t">{escape(_paragraph(rng))}</p></div>' for _ in range(10)))
+    html.append("</section></body></html>")
+    return "".join(html)
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        config = self.server.config
+        parsed = urlparse(self.path)
+        match = re.fullmatch(rf"/s/{re.escape(config.series)}-part-(\d+)", parsed.path)
+        page = int(parse_qs(parsed.query).get("page", ["1"])[0])
+        if not match or not 1 <= int(match.group(1)) <= config.parts or not 1 <= page <= config.pages:
+            self.send_error(404)
+            return
+
+        if config.latency:
+            time.sleep(config.latency)
+        self.server.record_request()
+
+        body = render_page(config, self.server.base_url, int(match.group(1)), page).encode("utf-8")
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """Threaded HTTP server for the synthetic series, counting requests served."""
+
+    daemon_threads = True
+
+    def __init__(self, config, host="127.0.0.1", port=0):
+        super().__init__((host, port), FixtureHandler)
+        self.config = config
+        self.base_url = f"http://{host}:{self.server_address[1]}"
+        self.requests = 0
+        self.requests_lock = threading.Lock()
+
+    def record_request(self):
+        with self.requests_lock:
+            self.requests += 1
+
+    @property
+    def first_url(self):
+        return f"{self.base_url}/s/{self.config.series}-part-1"
+
+    def start(self):
+        """Serve from a background thread and return self."""
+        threading.Thread(target=self.serve_forever, name="fixture-server", daemon=True).start()
+        return self
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--port", type=int, default=8765)
+    arg_parser.add_argument("--parts", type=int, default=3, help="parts (chapters) in the series")
+    arg_parser.add_argument("--pages", type=int, default=3, help="pages per part")
+    arg_parser.add_argument("--paragraphs", type=int, default=25, help="paragraphs per page")
+    arg_parser.add_argument("--latency-ms", type=float, default=0, help="delay added to every response")
+    args = arg_parser.parse_args()
+
+    config = FixtureConfig(args.parts, args.pages, args.paragraphs, args.latency_ms / 1000)
+    server = FixtureServer(config, port=args.port)
+    print(f"Serving {config.parts} parts x {config.pages} pages at {server.first_url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
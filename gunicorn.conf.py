@@ -0,0 +1,49 @@
+# Production server settings, used by the Docker image:
+#
+#     gunicorn --config gunicorn.conf.py
+#
+# Every setting can be overridden through the environment variables below.
+import multiprocessing
+import os
+
+wsgi_app = "app:create_app()"
+
+# Address and port the server listens on
+bind = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+
+# Worker processes. Job status, progress streams and coalescing live in each
+# process's memory, so status requests must reach the process that queued the
+# job; keep a single process unless requests are pinned to workers upstream.
+workers = int(os.environ.get("WEB_WORKERS", "1"))
+
+# Request threads per worker. Downloads run on the job pool rather than on
+# request threads, but every open progress stream holds a thread, so this
+# scales with the number of cores.
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", str(max(8, 4 * multiprocessing.cpu_count()))))
+
+# Import the application once in the master so fonts, templates and compiled
+# parsers are shared by forked workers. Thread pools and the log writer are
+# started lazily, so each worker creates its own after the fork.
+preload_app = True
+
+# Seconds a worker may go silent before it is restarted. Threaded workers keep
+# signalling while requests run, so this does not cut off long progress streams.
+timeout = int(os.environ.get("WEB_TIMEOUT", "120"))
+
+# Seconds a stopping worker gets to finish running downloads on restart or deploy
+graceful_timeout = int(os.environ.get("WEB_GRACEFUL_TIMEOUT", "300"))
+
+# Seconds an idle keep-alive connection stays open
+keepalive = int(os.environ.get("WEB_KEEPALIVE", "5"))
+
+accesslog = "-"
+errorlog = "-"
+
+
+def when_ready(server):
+    # Load the cover fonts and compile the page template before the workers fork
+    from app.utils import get_cover_fonts
+
+    get_cover_fonts()
+    server.app.wsgi().jinja_env.get_template("index.html")
@@ -1,3 +1,5 @@
+import os
+
 from app import create_app
 
 # Create the app using the factory function in app/__init__.py
@@ -5,5 +7,7 @@ app = create_app()
 
 if __name__ == "__main__":
     # For local development:
-    # Run the app directly using Flask's built-in development server
-    app.run(host="0.0.0.0", port=5015, debug=True)
\ No newline at end of file
+    # Run the app directly using Flask's built-in development server.
+    # Production deployments use gunicorn with gunicorn.conf.py instead.
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", "5015")),
+            debug=os.environ.get("FLASK_DEBUG", "0").lower() in ("1", "true", "yes"))
\ No newline at end of file